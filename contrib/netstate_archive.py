@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Read the snapshot archive written by modules/ffda_netstate.py (archive_dir).
+
+    python contrib/netstate_archive.py show ARCHIVE_DIR DOMAIN "2015-06-01 12:00" [-o nodes.json]
+    python contrib/netstate_archive.py info ARCHIVE_DIR DOMAIN 2015-06-01
+    python contrib/netstate_archive.py bench [--nodes 10000] [--snapshots 240]
+
+show writes the map data as of the given local time as a nodes.json-like
+document. bench archives synthetic snapshots in which some nodes change
+and reports the archive size against the raw data and the time to
+reconstruct the last snapshot.
+"""
+from __future__ import print_function, division
+
+import argparse
+import copy
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'willie'))
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import willie.bot  # noqa: E402,F401  (the bot is loaded before its modules)
+import ffda_netstate  # noqa: E402
+
+
+def parse_time(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    return float(value)
+
+
+def show(args):
+    result = ffda_netstate.reconstruct_snapshot(args.directory, args.domain, parse_time(args.time))
+    if result is None:
+        sys.exit('No snapshot archived at that time.')
+    timestamp, entries = result
+    document = {'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+                'nodes': list(entries.values())}
+    with (open(args.output, 'w') if args.output else sys.stdout) as output:
+        json.dump(document, output)
+    print('{} nodes as of {}'.format(len(entries), document['timestamp']), file=sys.stderr)
+
+
+def info(args):
+    path = ffda_netstate.archive_name(args.directory, args.domain, parse_time(args.day))
+    index = ffda_netstate.read_archive_index(path)
+    keyframes = sum(1 for record in index if record[2] == ffda_netstate.KEYFRAME)
+    size = os.path.getsize(path)
+    print('{}: {} snapshots, {} keyframes, {:.1f} MB ({:.1f} kB per snapshot)'.format(
+        os.path.basename(path), len(index), keyframes, size / 2 ** 20,
+        size / 1024 / max(len(index), 1)))
+    if index:
+        print('from {} to {}'.format(datetime.fromtimestamp(index[0][0]),
+                                     datetime.fromtimestamp(index[-1][0])))
+
+
+def churn(document, rng, share=0.1):
+    """Change clients and uptime of a share of the nodes, as between polls."""
+    for node in rng.sample(document['nodes'], int(len(document['nodes']) * share)):
+        statistics = node['statistics']
+        statistics['clients'] = rng.randint(0, 20)
+        statistics['uptime'] += ffda_netstate.POLL_INTERVAL
+
+
+def bench(args):
+    import netstate_bench
+    rng = random.Random(3)
+    document = netstate_bench.make_document(args.nodes)
+    directory = tempfile.mkdtemp(prefix='netstate-archive-')
+    archive = ffda_netstate.SnapshotArchive(directory)
+    start_time = 1433160000
+    raw = 0
+    elapsed = 0
+    try:
+        for i in range(args.snapshots):
+            churn(document, rng)
+            payload = json.dumps(document).encode('utf-8')
+            raw += len(payload)
+            started = time.time()
+            archive.write('bench', start_time + i * ffda_netstate.POLL_INTERVAL,
+                          ffda_netstate.document_entries(json.loads(payload.decode('utf-8'))))
+            elapsed += time.time() - started
+        expected = copy.deepcopy(ffda_netstate.document_entries(document))
+
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        started = time.time()
+        _, entries = ffda_netstate.reconstruct_snapshot(
+            directory, 'bench', start_time + (args.snapshots - 1) * ffda_netstate.POLL_INTERVAL)
+        reconstruct = time.time() - started
+        assert entries == expected, 'reconstructed snapshot differs'
+    finally:
+        shutil.rmtree(directory)
+
+    print('{} snapshots of {} nodes: raw {:.1f} MB, archived {:.2f} MB ({:.1f}x), '
+          'writing {:.0f} ms per snapshot, reconstructing the last one {:.2f} s'.format(
+              args.snapshots, args.nodes, raw / 2 ** 20, size / 2 ** 20, raw / size,
+              elapsed / args.snapshots * 1000, reconstruct))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('show', help='reconstruct the map data at a time')
+    command.add_argument('directory')
+    command.add_argument('domain')
+    command.add_argument('time', help='local time, YYYY-MM-DD [HH:MM[:SS]] or unix time')
+    command.add_argument('-o', '--output', help='file to write instead of stdout')
+    command.set_defaults(func=show)
+    command = commands.add_parser('info', help='summarize the segment of a day')
+    command.add_argument('directory')
+    command.add_argument('domain')
+    command.add_argument('day', help='YYYY-MM-DD')
+    command.set_defaults(func=info)
+    command = commands.add_parser('bench', help='archive synthetic snapshots')
+    command.add_argument('--nodes', type=int, default=10000)
+    command.add_argument('--snapshots', type=int, default=240)
+    command.set_defaults(func=bench)
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.error('a command is required')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for modules/ffda_netstate.py on synthetic map data.
+
+    python contrib/netstate_bench.py [adapters|graph|near|parse|search] [--sizes 1000,10000,50000]
+"""
+from __future__ import print_function, division
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'willie'))
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+
+import willie.bot  # noqa: E402,F401  (the bot is loaded before its modules)
+import ffda_netstate  # noqa: E402
+
+
+def make_node(rng, i, gateways=8):
+    online = rng.random() < 0.85
+    mac = '60:e3:27:{:02x}:{:02x}:{:02x}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+    return {
+        'firstseen': '2015-01-01T00:00:00',
+        'lastseen': '2015-06-01T12:00:00',
+        'flags': {'online': online, 'gateway': False},
+        'nodeinfo': {
+            'node_id': mac.replace(':', ''),
+            'hostname': 'ffda-node-{}'.format(i),
+            'network': {'mac': mac, 'addresses': ['fdca:ffee:ffda::{:x}'.format(i)]},
+            'location': {'latitude': 49.8 + rng.random() / 10,
+                         'longitude': 8.6 + rng.random() / 10},
+            'software': {
+                'firmware': {'base': 'gluon-v2015.1', 'release': rng.choice(['0.6', '0.7', '0.7.1'])},
+                'autoupdater': {'enabled': True, 'branch': rng.choice(['stable', 'beta'])},
+            },
+            'hardware': {'model': rng.choice(['TP-Link TL-WR841N/ND v9', 'TP-Link TL-WR842N/ND v2'])},
+        },
+        'statistics': {
+            'clients': rng.randint(0, 20) if online else 0,
+            'gateway': 'de:ad:be:ef:00:{:02x}'.format(rng.randrange(gateways)),
+            'uptime': rng.random() * 1e6,
+            'loadavg': rng.random(),
+            'memory_usage': rng.random(),
+        },
+    }
+
+
+def to_meshviewer(node):
+    nodeinfo, statistics = node['nodeinfo'], node['statistics']
+    return {
+        'node_id': nodeinfo['node_id'],
+        'hostname': nodeinfo['hostname'],
+        'mac': nodeinfo['network']['mac'],
+        'addresses': nodeinfo['network']['addresses'],
+        'location': nodeinfo['location'],
+        'firmware': nodeinfo['software']['firmware'],
+        'autoupdater': nodeinfo['software']['autoupdater'],
+        'model': nodeinfo['hardware']['model'],
+        'is_online': node['flags']['online'],
+        'is_gateway': node['flags']['gateway'],
+        'clients': statistics['clients'],
+        'gateway': statistics['gateway'],
+        'uptime': statistics['uptime'],
+        'loadavg': statistics['loadavg'],
+        'memory_usage': statistics['memory_usage'],
+        'firstseen': node['firstseen'],
+        'lastseen': node['lastseen'],
+    }
+
+
+def make_document(count, fmt='nodes_v2', seed=42):
+    rng = random.Random(seed)
+    nodes = [make_node(rng, i) for i in range(count)]
+    if fmt == 'nodes_v1':
+        return {'version': 1, 'timestamp': '2015-06-01T12:00:00',
+                'nodes': dict((n['nodeinfo']['node_id'], n) for n in nodes)}
+    if fmt == 'meshviewer':
+        return {'timestamp': '2015-06-01T12:00:00',
+                'nodes': [to_meshviewer(n) for n in nodes], 'links': []}
+    if fmt == 'graph':
+        batadv = {
+            'directed': False, 'graph': [],
+            'nodes': [{'id': n['nodeinfo']['network']['mac'], 'node_id': n['nodeinfo']['node_id']}
+                      for n in nodes if n['flags']['online']],
+        }
+        batadv['links'] = [{'source': i, 'target': rng.randrange(len(batadv['nodes'])),
+                            'tq': rng.random(), 'vpn': False}
+                           for i in range(len(batadv['nodes']))]
+        return {'version': 1, 'batadv': batadv}
+    return {'version': 2, 'timestamp': '2015-06-01T12:00:00', 'nodes': nodes}
+
+
+def make_payload(count, fmt='nodes_v2', seed=42):
+    return json.dumps(make_document(count, fmt, seed)).encode('utf-8')
+
+
+def chunked(payload, size=ffda_netstate.CHUNK_SIZE):
+    for offset in range(0, len(payload), size):
+        yield payload[offset:offset + size]
+
+
+def parse_loads(payload):
+    document = json.loads(payload.decode('utf-8'))
+    return ffda_netstate.aggregate(ffda_netstate.iter_document(document, {}), counts=new_counts())
+
+
+def parse_stream(payload):
+    return ffda_netstate.aggregate(ffda_netstate.iter_map(chunked(payload), {}),
+                                   counts=new_counts())
+
+
+def new_counts():
+    return dict((name, {}) for name in ffda_netstate.DISTRIBUTIONS)
+
+
+def measure(func, payload, repeat):
+    gc.collect()
+    tracemalloc.start()
+    result = func(payload)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(payload)
+        best = min(best, time.perf_counter() - start)
+    return result, peak, best
+
+
+def bench_parse(args):
+    print('{:>7} {:>9} {:>8} {:>12} {:>10}'.format('nodes', 'payload', 'mode', 'peak mem', 'time'))
+    for size in args.sizes:
+        payload = make_payload(size)
+        results = []
+        for name, func in (('loads', parse_loads), ('stream', parse_stream)):
+            result, peak, best = measure(func, payload, args.repeat)
+            results.append(result)
+            print('{:>7} {:>8.1f}M {:>8} {:>11.1f}M {:>9.3f}s'.format(
+                size, len(payload) / 2 ** 20, name, peak / 2 ** 20, best))
+        assert results[0] == results[1], results
+
+
+def bench_adapters(args):
+    """Per-node cost of each format adapter, without JSON decoding."""
+    size = max(args.sizes)
+    print('{:>11} {:>7} {:>12}'.format('format', 'nodes', 'per node'))
+    for fmt in sorted(ffda_netstate.MAP_FORMATS):
+        document = make_document(size, fmt)
+        best = float('inf')
+        for _ in range(args.repeat):
+            info = {}
+            start = time.perf_counter()
+            ffda_netstate.aggregate(ffda_netstate.iter_document(document, info))
+            best = min(best, time.perf_counter() - start)
+        assert info['format'] == fmt, info
+        print('{:>11} {:>7} {:>10.2f}us'.format(fmt, size, best / size * 1e6))
+
+
+def bench_search(args):
+    """Latency of .node lookups against a linear scan of the hostnames,
+    and the time of a poll that renames 1% of the nodes."""
+    rng = random.Random(1)
+    print('{:>7} {:>10} {:>11} {:>11} {:>11}'.format(
+        'nodes', 'query', 'indexed', 'scan', 'poll'))
+    for size in args.sizes:
+        document = make_document(size)
+        index = ffda_netstate.NodeIndex()
+        index.begin(0, 1800, 4)
+        records = list(ffda_netstate.iter_document(document, {}))
+        ffda_netstate.aggregate(records, index)
+        index.finish()
+
+        renamed = list(records)
+        for i in rng.sample(range(size), max(size // 100, 1)):
+            renamed[i] = (renamed[i][0], 'renamed-{}'.format(i)) + renamed[i][2:]
+        index.begin(15, 1800, 4)
+        start = time.perf_counter()
+        ffda_netstate.aggregate(renamed, index)
+        renames = time.perf_counter() - start
+        index.finish()
+
+        i = rng.randrange(size)
+        queries = (('prefix', 'ffda-node-{}'.format(i)[:-1]),
+                   ('substring', 'node-{}'.format(i)[:-1]),
+                   ('mac', '60:e3:27:{:02x}:{:02x}'.format(i >> 16 & 255, i >> 8 & 255)))
+        for name, query in queries:
+            indexed = min(timed(index.lookup, query) for _ in range(args.repeat * 10))
+            scan = min(timed(linear_lookup, index, query) for _ in range(args.repeat))
+            print('{:>7} {:>10} {:>9.1f}us {:>9.1f}us {:>9.1f}ms'.format(
+                size, name, indexed * 1e6, scan * 1e6, renames * 1e3))
+
+
+def bench_near(args):
+    """Latency of .near queries on the grid against computing every distance."""
+    rng = random.Random(2)
+    print('{:>7} {:>8} {:>11} {:>11}'.format('nodes', 'radius', 'grid', 'scan'))
+    for size in args.sizes:
+        index = ffda_netstate.NodeIndex()
+        index.begin(0, 1800, 4)
+        ffda_netstate.aggregate(ffda_netstate.iter_document(make_document(size), {}), index)
+        index.finish()
+        latitude, longitude = 49.8 + rng.random() / 10, 8.6 + rng.random() / 10
+        for radius in (300, 1000, 3000):
+            grid = min(timed(index.near, latitude, longitude, radius)
+                       for _ in range(args.repeat * 10))
+            scan = min(timed(linear_near, index, latitude, longitude, radius)
+                       for _ in range(args.repeat))
+            print('{:>7} {:>7}m {:>9.1f}us {:>9.1f}us'.format(
+                size, radius, grid * 1e6, scan * 1e6))
+
+
+def make_graph(links, seed=4, islands=20):
+    """A graph.json of about the given number of links: a tree of nodes, a
+    fifth of them with a VPN link, plus a few small islands without one."""
+    rng = random.Random(seed)
+    count = links * 5 // 6
+    nodes = [{'id': '60:e3:27:{:06x}'.format(i), 'node_id': '60e327{:06x}'.format(i)}
+             for i in range(count)]
+    edges = [{'source': i, 'target': rng.randrange(i), 'tq': 1.0, 'vpn': False}
+             for i in range(1, count)]
+    edges += [{'source': i, 'target': 0, 'tq': 1.0, 'vpn': True}
+              for i in rng.sample(range(count), count // 5)]
+    # cut a few pairs loose: both ends only link to each other
+    for i in range(islands):
+        a, b = count + 2 * i, count + 2 * i + 1
+        nodes += [{'id': 'island-{}'.format(a), 'node_id': 'island{}'.format(a)},
+                  {'id': 'island-{}'.format(b), 'node_id': 'island{}'.format(b)}]
+        edges.append({'source': a, 'target': b, 'tq': 1.0, 'vpn': False})
+    return json.dumps({'version': 1, 'batadv': {'directed': False, 'graph': [],
+                                                 'nodes': nodes, 'links': edges}}).encode('utf-8')
+
+
+def bench_graph(args):
+    """Streaming a graph.json and finding its partitions with union-find."""
+    print('{:>7} {:>7} {:>9} {:>10} {:>11}'.format('links', 'nodes', 'payload', 'parse', 'partition'))
+    for links in (1000, 10000, 100000):
+        payload = make_graph(links)
+        parse = min(timed(ffda_netstate.iter_graph, chunked(payload)) for _ in range(args.repeat))
+        nodes, edges = ffda_netstate.iter_graph(chunked(payload))
+        partition = min(timed(ffda_netstate.find_partitions, nodes, edges)
+                        for _ in range(args.repeat))
+        mesh = ffda_netstate.find_partitions(nodes, edges)
+        assert len(mesh.islands) == 20 and mesh.components == 21, mesh.components
+        print('{:>7} {:>7} {:>8.1f}M {:>9.3f}s {:>9.1f}ms'.format(
+            len(edges), len(nodes), len(payload) / 2 ** 20, parse, partition * 1e3))
+
+
+def linear_near(index, latitude, longitude, radius):
+    hits = []
+    for slot in range(len(index)):
+        metres = ffda_netstate.distance(latitude, longitude,
+                                        index.latitude[slot], index.longitude[slot])
+        if metres <= radius:
+            hits.append((metres, slot))
+    return sorted(hits)
+
+
+def linear_lookup(index, query, limit=10):
+    query = query.lower()
+    mac = query.replace(':', '')
+    found = []
+    for slot, hostname in enumerate(index.hostnames):
+        if (query in (hostname or '').lower() or index.ids[slot].startswith(mac)) and len(found) < limit:
+            found.append(slot)
+    return found
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+BENCHMARKS = {
+    'adapters': bench_adapters,
+    'graph': bench_graph,
+    'near': bench_near,
+    'parse': bench_parse,
+    'search': bench_search,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of {} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        type=lambda v: [int(s) for s in v.split(',')])
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark: {}'.format(', '.join(sorted(unknown))))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('== {} =='.format(name))
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replay recorded map data through modules/ffda_netstate.py on a simulated clock.
+
+    python contrib/netstate_replay.py SNAPSHOT_DIR [--set flap_window=600]
+    python contrib/netstate_replay.py --synthetic 500 --nodes 5000 --quiet
+
+Snapshots are nodes.json (or meshviewer.json, graph.json) files, optionally
+gzipped. Their time is taken from a unix timestamp in the file name, e.g.
+nodes-1433160000.json.gz, or from the file's modification time. They are
+processed in time order as fast as possible; the announcements the bot would
+have sent are printed with their simulated time, followed by snapshots per
+second and peak RSS.
+"""
+from __future__ import print_function, division
+
+import argparse
+import gzip
+import io
+import itertools
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'willie'))
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+
+import willie.bot  # noqa: E402,F401  (the bot is loaded before its modules)
+from willie.config import Config  # noqa: E402
+from willie.db import WillieDB  # noqa: E402
+import ffda_netstate  # noqa: E402
+
+
+class SimulatedClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ReplayBot(object):
+    """Just enough of a Willie instance for the netstate module."""
+
+    def __init__(self, config, clock, output=None):
+        self.config = config
+        self.db = WillieDB(config)
+        self.memory = {}
+        self.clock = clock
+        self.output = output
+        self.messages = []
+
+    def msg(self, recipient, text, max_messages=1):
+        self.messages.append((self.clock(), recipient, text))
+        if self.output is not None:
+            stamp = datetime.fromtimestamp(self.clock()).strftime('%Y-%m-%d %H:%M:%S')
+            print('[{}] {}: {}'.format(stamp, recipient, text), file=self.output)
+
+
+def make_config(directory, options):
+    filename = os.path.join(directory, 'replay.cfg')
+    with io.open(filename, 'w', encoding='utf-8') as cfg:
+        cfg.write(u'[core]\nnick=replay\nowner=replay\nhost=localhost\n'
+                  u'db_filename={}\n\n[freifunk]\nannounce_target=#replay\n'
+                  u'ffmap_nodes_uri=replay\n'.format(os.path.join(directory, 'replay.db')))
+        for option in options:
+            key, _, value = option.partition('=')
+            cfg.write(u'{}={}\n'.format(key.strip(), value.strip()))
+    return Config(filename)
+
+
+def find_snapshots(directory):
+    snapshots = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        match = re.search(r'(\d{9,})', name)
+        timestamp = int(match.group(1)) if match else os.path.getmtime(path)
+        snapshots.append((timestamp, path))
+    snapshots.sort()
+    return snapshots
+
+
+def read_snapshot(path):
+    opener = gzip.open if path.endswith('.gz') else io.open
+    with opener(path, 'rb') as snapshot:
+        return snapshot.read()
+
+
+def synthetic_snapshots(count, nodes, variants=8, start=1433116800):
+    """Snapshots 15 s apart, cycling through a few generated payloads."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import netstate_bench
+    payloads = [netstate_bench.make_payload(nodes, seed=i) for i in range(min(count, variants))]
+    for i in range(count):
+        yield start + i * ffda_netstate.POLL_INTERVAL, payloads[i % len(payloads)]
+
+
+def chunked(payload, size=ffda_netstate.CHUNK_SIZE):
+    for offset in range(0, len(payload), size):
+        yield payload[offset:offset + size]
+
+
+def replay(bot, snapshots):
+    """Feed (timestamp, payload) pairs through the pipeline of a poll."""
+    ffda = bot.memory['ffda']
+    domain = next(iter(ffda['domains'].values()))
+    count = 0
+    for timestamp, payload in snapshots:
+        bot.clock.now = timestamp
+        ffda_netstate.check_daychange(bot)
+        try:
+            ffda_netstate.apply_map_data(bot, domain, chunked(payload))
+        except (ValueError, KeyError) as e:
+            print('Skipping snapshot at {}: {}'.format(timestamp, e), file=sys.stderr)
+            continue
+        ffda_netstate.update_total(bot)
+        ffda_netstate.record_uptime(bot, domain)
+        ffda['history'].add(timestamp, ffda['status'])
+        ffda_netstate.check_alerts(bot)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('directory', nargs='?', help='directory of recorded snapshots')
+    parser.add_argument('--synthetic', type=int, metavar='COUNT',
+                        help='replay COUNT generated snapshots instead')
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='nodes per generated snapshot (default: 1000)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='[freifunk] option for the replay, may be repeated')
+    parser.add_argument('--quiet', action='store_true', help='do not print announcements')
+    args = parser.parse_args()
+    if not args.directory and not args.synthetic:
+        parser.error('either a snapshot directory or --synthetic is required')
+
+    if args.synthetic:
+        snapshots = synthetic_snapshots(args.synthetic, args.nodes)
+    else:
+        snapshots = ((timestamp, read_snapshot(path))
+                     for timestamp, path in find_snapshots(args.directory))
+
+    snapshots = iter(snapshots)
+    try:
+        first = next(snapshots)
+    except StopIteration:
+        parser.error('no snapshots found')
+    snapshots = itertools.chain((first,), snapshots)
+
+    workdir = tempfile.mkdtemp(prefix='netstate-replay-')
+    clock = SimulatedClock()
+    clock.now = first[0]
+    ffda_netstate.clock = clock
+    # the module logs to stdout as well, keep only the announcements
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        bot = ReplayBot(make_config(workdir, args.set), clock, None if args.quiet else stdout)
+        ffda_netstate.setup(bot)
+        start = time.time()
+        count = replay(bot, snapshots)
+        elapsed = time.time() - start
+        ffda_netstate.shutdown(bot)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    print('{} snapshots in {:.2f}s ({:.1f}/s), {} announcements, peak RSS {:.1f}M'.format(
+        count, elapsed, count / elapsed if elapsed else 0, len(bot.messages), peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
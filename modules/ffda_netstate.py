@@ -1,130 +1,2628 @@
 # -*- coding: utf-8 -*-
-from __future__ import print_function
-
+from __future__ import print_function, unicode_literals
+
+import binascii
+import bisect
+import codecs
+from array import array
+from collections import deque, OrderedDict
+import hashlib
+import itertools
 import json
+import math
+import mmap
+import os
+import re
 import shelve
+import struct
+import sys
+import threading
 import time
 import traceback
+import zlib
 from datetime import datetime, date, timedelta
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import requests
 from requests.compat import urljoin
 
 import willie
 
+# keep-alive connections to the map servers, shared by all polls
+SESSION = requests.Session()
+# held for the duration of a poll, the scheduler starts a thread every 15 s
+UPDATE_LOCK = threading.Lock()
+# guards the combined total, which every domain updates when it is done
+TOTAL_LOCK = threading.Lock()
+# worker threads fetching the domains, started by setup()
+POLL_POOL = None
+# serves the metrics if metrics_port is configured
+METRICS_SERVER = None
+# writes map snapshots to archive_dir if it is configured
+ARCHIVE = None
+# guards the registry of every node ever seen, shared by all domains
+REGISTRY_LOCK = threading.Lock()
+
+# source of the current time, replays substitute a simulated clock
+clock = time.time
+
+POLL_INTERVAL = 15
+MAX_BACKOFF = 15 * 60
+FETCH_STATS = ('full', 'not_modified', 'unchanged', 'failed', 'bytes')
+# node properties counted by .firmware, .models and .branches
+DISTRIBUTIONS = ('firmware', 'model', 'branch')
+
 
 def setup(bot):
-    hs = shelve.open("ffda-highscore", writeback=True)
+    global POLL_POOL, METRICS_SERVER, ARCHIVE
+
+    configured = load_domains(bot)
+    graphs = load_graphs(bot, configured)
+    domains = OrderedDict()
+    for name, uri in configured:
+        # with a single domain its highscore is the total one
+        hs = open_highscore(bot.db, name) if len(configured) > 1 else None
+        domains[name] = Domain(name, uri, hs, graphs.get(name))
+
+    if POLL_POOL is not None:
+        POLL_POOL.stop()
+    POLL_POOL = PollPool(min(len(domains), int(bot.config.freifunk.ffmap_workers or 4)))
+
+    bot.memory['ffda'] = {
+        'highscore': open_highscore(bot.db),
+        'domains': domains,
+        'history': TimeSeries(HISTORY_TIERS),
+        'alerts': load_alerts(bot),
+        'registry': open_registry(bot, domains),
+    }
+    # serve the state saved before a restart until the first poll is done
+    if config_bool(bot.config.freifunk.persist_state, True):
+        if any([load_state(bot, domain) for domain in domains.values()]):
+            update_total(bot)
+        # nodes of a restored index do not appear again, register them now
+        registry = bot.memory['ffda']['registry']
+        for domain in domains.values():
+            if len(domain.nodes):
+                with REGISTRY_LOCK:
+                    registry.add(domain.name, list(domain.nodes.ids), domain.nodes.now)
+        for domain in domains.values():
+            load_uptime(bot, domain)
+    render_metrics(bot)
+
+    if ARCHIVE is not None:
+        ARCHIVE.stop()
+        ARCHIVE = None
+    if bot.config.freifunk.archive_dir:
+        directory = os.path.expanduser(bot.config.freifunk.archive_dir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        ARCHIVE = SnapshotArchive(directory, parse_duration(
+            bot.config.freifunk.archive_keyframe_interval or '1h'))
+        ARCHIVE.start()
+
+    if METRICS_SERVER is not None:
+        stop_metrics_server(METRICS_SERVER)
+        METRICS_SERVER = None
+    if bot.config.freifunk.metrics_port:
+        METRICS_SERVER = start_metrics_server(
+            bot, bot.config.freifunk.metrics_address or '127.0.0.1',
+            int(bot.config.freifunk.metrics_port))
+
+
+def load_domains(bot):
+    """Return (name, nodes URI) of every configured mesh domain."""
+    domains = []
+    for entry in bot.config.freifunk.get_list('ffmap_domains'):
+        name, _, uri = entry.partition('=')
+        domains.append((name.strip(), uri.strip()))
+    if not domains:
+        domains.append(('ffda', bot.config.freifunk.ffmap_nodes_uri))
+    return domains
+
+
+def load_graphs(bot, configured):
+    """Return the link graph URI of every domain that has one."""
+    graphs = {}
+    for entry in bot.config.freifunk.get_list('ffmap_graphs'):
+        name, _, uri = entry.partition('=')
+        graphs[name.strip()] = uri.strip()
+    if not graphs and bot.config.freifunk.ffmap_graph_uri and len(configured) == 1:
+        graphs[configured[0][0]] = bot.config.freifunk.ffmap_graph_uri
+    return graphs
+
+
+def open_highscore(db, domain=''):
+    hs = HighscoreStore(db, domain)
+    if not domain and not hs.keys():
+        import_shelve(hs, "ffda-highscore")
 
     # total highscore
     if 'nodes' not in hs:
         hs['nodes'] = 0
-        hs['nodes_dt'] = time.time()
+        hs['nodes_dt'] = clock()
     if 'clients' not in hs:
         hs['clients'] = 0
-        hs['clients_dt'] = time.time()
+        hs['clients_dt'] = clock()
 
     # end of day highscore, also clean up if we load a daychange from file
     try:
         if day_changed(hs['daily_dt']):
+            hs.record_day()
             reset_highscore(hs)
     except KeyError:
         reset_highscore(hs)
-
-    bot.memory['ffda'] = {'highscore': hs}
+    hs.flush()
+    return hs
 
 
-def reset_highscore(highscore):
-    highscore['daily_nodes'] = 0
-    highscore['daily_nodes_dt'] = time.time()
-    highscore['daily_clients'] = 0
-    highscore['daily_clients_dt'] = time.time()
-    highscore['daily_dt'] = time.time()
+def reset_highscore(highscore, status=None):
+    """Start a new day, from the current status if there is one, as polls
+    without new data do not update the highscore."""
+    nodes, _, clients = status or (0, 0, 0)
+    highscore['daily_nodes'] = nodes
+    highscore['daily_nodes_dt'] = clock()
+    highscore['daily_clients'] = clients
+    highscore['daily_clients_dt'] = clock()
+    highscore['daily_dt'] = clock()
 
 
 def shutdown(bot):
+    if POLL_POOL is not None:
+        POLL_POOL.stop()
+    if METRICS_SERVER is not None:
+        stop_metrics_server(METRICS_SERVER)
+    if ARCHIVE is not None:
+        ARCHIVE.stop()
+    SESSION.close()
+    if 'ffda' in bot.memory and config_bool(bot.config.freifunk.persist_state, True):
+        for domain in bot.memory['ffda']['domains'].values():
+            save_uptime(bot, domain)
     try:
-        hs = bot.memory['ffda']['highscore']
-        hs.close()
+        for hs in highscores(bot):
+            hs.flush()
     except KeyError:
         pass
 
 
-@willie.module.interval(15)
-def update(bot):
-    result = requests.get(bot.config.freifunk.ffmap_nodes_uri)
-    result.encoding = "UTF-8"
+def highscores(bot):
+    """The total highscore followed by those of the domains."""
+    ffda = bot.memory['ffda']
+    yield ffda['highscore']
+    for domain in ffda['domains'].values():
+        if domain.highscore is not None:
+            yield domain.highscore
+
+
+class Domain(object):
+    """A mesh domain, its map data source and the state derived from it."""
+
+    def __init__(self, name, uri, highscore=None, graph_uri=None):
+        self.name = name
+        self.uri = uri
+        self.highscore = highscore
+        self.fetch = {}
+        self.stats = dict.fromkeys(FETCH_STATS, 0)
+        # the optional link graph and its components
+        self.graph_uri = graph_uri
+        self.graph_fetch = {}
+        self.graph_stats = dict.fromkeys(FETCH_STATS, 0)
+        self.mesh = None
+        self.graph_seconds = 0.0
+        self.nodes = NodeIndex()
+        self.status = None
+        # online nodes per firmware, model and branch, and the same ranked
+        self.counts = {}
+        self.distribution = {}
+        # [nodes, clients] of the online nodes per gateway
+        self.gateways = {}
+        self.uptime = Uptime()
+        self.current = False
+        # full fetches of the map data and the link graph so far
+        self.updates = 0
+        # measurements of the last poll
+        self.poll_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.fetch_bytes = 0
+        # held while the domain is being polled
+        self.lock = threading.Lock()
+
+
+class PollPool(object):
+    """A fixed number of threads running poll jobs from a queue."""
+
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self.jobs = Queue.Queue()
+        for _ in range(self.size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception:
+                print(traceback.format_exc())
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def stop(self):
+        for _ in range(self.size):
+            self.jobs.put(None)
+
+
+class HighscoreStore(object):
+    """
+    Highscores of one domain ('' for the total) held in memory and persisted
+    to the bot database.
+
+    Assignments only mark a field dirty when its value changes; flush() writes
+    the dirty fields and the finished days to the database in one transaction.
+    """
+
+    def __init__(self, db, domain=''):
+        self.db = db
+        self.domain = domain
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._days = []
+        conn = self.db.connect()
+        try:
+            with conn:
+                add_domain_column(conn, 'ffda_highscore',
+                                  '(domain STRING, key STRING, value, '
+                                  'PRIMARY KEY (domain, key))')
+                add_domain_column(conn, 'ffda_highscore_history',
+                                  '(domain STRING, day STRING, nodes INTEGER, nodes_dt REAL, '
+                                  'clients INTEGER, clients_dt REAL, PRIMARY KEY (domain, day))')
+            self._values = dict(conn.execute(
+                'SELECT key, value FROM ffda_highscore WHERE domain = ?', (domain,)).fetchall())
+        finally:
+            conn.close()
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if self._values.get(key) != value:
+                self._values[key] = value
+                self._dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def keys(self):
+        return list(self._values.keys())
+
+    def record_day(self):
+        """Queue the daily highscore for the history table."""
+        day = datetime.fromtimestamp(self['daily_dt']).strftime('%Y-%m-%d')
+        with self._lock:
+            self._days.append((self.domain, day, self['daily_nodes'], self['daily_nodes_dt'],
+                               self['daily_clients'], self['daily_clients_dt']))
+
+    def flush(self):
+        with self._lock:
+            values = [(self.domain, key, self._values[key]) for key in self._dirty]
+            days = self._days
+            self._dirty = set()
+            self._days = []
+        if not values and not days:
+            return
+
+        conn = self.db.connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO ffda_highscore (domain, key, value) '
+                                 'VALUES (?, ?, ?)', values)
+                conn.executemany('INSERT OR REPLACE INTO ffda_highscore_history '
+                                 '(domain, day, nodes, nodes_dt, clients, clients_dt) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', days)
+        except Exception:
+            # keep the changes for the next attempt
+            with self._lock:
+                self._dirty.update(key for _, key, _ in values)
+                self._days[:0] = days
+            raise
+        finally:
+            conn.close()
+
+
+def add_domain_column(conn, table, schema):
+    """Create table, or rebuild a table of a single domain version with the
+    domain as part of its primary key."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+    if 'domain' in columns:
+        return
+    conn.execute('CREATE TABLE {}_new {}'.format(table, schema))
+    if columns:
+        conn.execute("INSERT INTO {0}_new ({1}, domain) SELECT {1}, '' FROM {0}".format(
+            table, ', '.join(columns)))
+        conn.execute('DROP TABLE {}'.format(table))
+    conn.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(table))
+
+
+def import_shelve(hs, filename):
+    """Take over the highscores of the shelve used by earlier versions."""
     try:
-        mapdata = json.loads(result.text)
-    except ValueError:
-        print(traceback.format_exc())
+        old = shelve.open(filename, flag='r')
+    except Exception:
+        return
+    try:
+        for key in old.keys():
+            hs[key] = old[key]
+    finally:
+        old.close()
+    print('Imported highscores from {}.'.format(filename))
+
+
+@willie.module.interval(60)
+def flush_highscore(bot):
+    for hs in highscores(bot):
+        hs.flush()
+
+
+@willie.module.interval(POLL_INTERVAL)
+def update(bot):
+    if not UPDATE_LOCK.acquire(False):
+        print('Warning: Previous update still running, skipping this one.')
         return
+    try:
+        poll_domains(bot)
+    finally:
+        UPDATE_LOCK.release()
 
-    gateway_set = set()
+
+def poll_domains(bot):
+    """
+    Poll all domains concurrently. Each domain publishes its status and
+    updates the combined total as soon as it is done, so slow or failing
+    domains do not hold up the others; domains still busy from an earlier
+    poll are skipped. The history gets one sample of the total per poll.
+    """
+    ffda = bot.memory['ffda']
+    domains = list(ffda['domains'].values())
+
+    check_daychange(bot)
+
+    pending = []
+    for domain in domains:
+        if not domain.lock.acquire(False):
+            continue
+        domain.current = False
+        done = threading.Event()
+        POLL_POOL.submit(poll_domain, bot, domain, done)
+        pending.append(done)
+
+    deadline = time.time() + POLL_INTERVAL - 1
+    for done in pending:
+        done.wait(max(deadline - time.time(), 0))
+
+    if 'status' in ffda and any(domain.current for domain in domains):
+        ffda['history'].add(clock(), ffda['status'])
+        check_alerts(bot)
+    if pending:
+        render_metrics(bot)
+
+
+def poll_domain(bot, domain, done):
+    started = time.time()
+    try:
+        domain.current = poll(bot, domain)
+        domain.poll_seconds = time.time() - started
+        # a failed poll may be the last one the total waited for
+        update_total(bot)
+        if domain.current:
+            record_uptime(bot, domain)
+        if domain.graph_uri:
+            poll_graph(bot, domain)
+    finally:
+        domain.lock.release()
+        done.set()
+
+
+def update_total(bot):
+    """Sum up the latest status of all domains."""
+    ffda = bot.memory['ffda']
+    domains = ffda['domains'].values()
+    with TOTAL_LOCK:
+        reported = [domain for domain in domains if domain.status is not None]
+        if not reported:
+            return
+        if len(reported) == 1:
+            ffda['distribution'] = reported[0].distribution
+        else:
+            ffda['distribution'] = rank_counts(merge_counts(reported))
+        # a gateway serving several domains counts once
+        status = (sum(d.status[0] for d in reported), len(merge_loads(reported)),
+                  sum(d.status[2] for d in reported))
+        # right after a start, wait for every domain to report or fail once
+        complete = domains_reported(domains)
+        if status == ffda.get('status') and complete == ffda.get('complete'):
+            return
+        ffda['status'] = status
+        ffda['complete'] = complete
+
+        if complete:
+            nodes, gateways, clients = status
+            update_highscore(bot, ffda['highscore'], nodes, clients, public=True)
+
+
+def domains_reported(domains):
+    """True once every domain reported a status or failed."""
+    return all(domain.status is not None or domain.stats['failed'] for domain in domains)
+
+
+def poll(bot, domain):
+    """Fetch and aggregate the map data of a domain, True if its status is
+    current."""
+    received = []
+
+    def apply(chunks):
+        # the archive needs the whole body after parsing
+        if ARCHIVE is not None:
+            chunks = list(chunks)
+            received.append(chunks)
+        apply_map_data(bot, domain, chunks)
+
+    result = fetch(bot, domain.name, domain.uri, domain.fetch, domain.stats, apply)
+    if result != 'full':
+        return result is not None
+
+    domain.fetch_bytes = domain.fetch['bytes']
+    domain.updates += 1
+    if received:
+        ARCHIVE.submit(domain.name, clock(), received[0])
+    if config_bool(bot.config.freifunk.persist_state, True):
+        try:
+            save_state(bot, domain)
+        except EnvironmentError as e:
+            print('Warning: Unable to save the state of {} ({}).'.format(domain.name, e))
+    return True
+
+
+def fetch(bot, name, uri, state, stats, apply):
+    """
+    GET uri with the validators of the previous response and pass the body
+    as an iterable of byte chunks to apply() if it changed. Returns 'full',
+    'not_modified' or 'unchanged' if the data is current and None if the
+    request or apply() failed; failing servers are backed off.
+    """
+    # back off while the map server is failing
+    if time.time() < state.get('retry_at', 0):
+        return None
+
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
+    timeout = (float(bot.config.freifunk.ffmap_connect_timeout or 5),
+               float(bot.config.freifunk.ffmap_read_timeout or 10))
+    try:
+        result = SESSION.get(uri, headers=headers, timeout=timeout, stream=True)
+    except requests.RequestException as e:
+        back_off(name, state, stats, e)
+        return None
+
+    try:
+        if result.status_code == 304:
+            state['failures'] = 0
+            stats['not_modified'] += 1
+            return 'not_modified'
+        result.raise_for_status()
+        state['failures'] = 0
+
+        validators = {
+            'etag': result.headers.get('ETag'),
+            'last_modified': result.headers.get('Last-Modified'),
+        }
+        chunks = result.iter_content(CHUNK_SIZE)
+
+        # without validators, fall back to comparing a hash of the body
+        digest = None
+        if not any(validators.values()):
+            chunks = list(chunks)
+            sha1 = hashlib.sha1()
+            for chunk in chunks:
+                sha1.update(chunk)
+            digest = sha1.hexdigest()
+            if digest == state.get('digest'):
+                stats['unchanged'] += 1
+                return 'unchanged'
+
+        try:
+            apply(chunks)
+        except (ValueError, KeyError) as e:
+            print(traceback.format_exc())
+            back_off(name, state, stats, e)
+            return None
+
+        state['bytes'] = result.raw.tell()
+        stats['full'] += 1
+        stats['bytes'] += state['bytes']
+        state.update(validators, digest=digest)
+    except requests.RequestException as e:
+        back_off(name, state, stats, e)
+        return None
+    finally:
+        result.close()
+
+    return 'full'
+
+
+def poll_graph(bot, domain):
+    """Fetch the link graph of a domain and find its partitions."""
+    def apply(chunks):
+        started = time.time()
+        mesh = find_partitions(*iter_graph(chunks))
+        domain.graph_seconds = time.time() - started
+        previous, domain.mesh = domain.mesh, mesh
+        domain.updates += 1
+        announce_partitions(bot, domain, previous)
+
+    fetch(bot, domain.name, domain.graph_uri, domain.graph_fetch, domain.graph_stats, apply)
+
+
+def apply_map_data(bot, domain, chunks):
+    """Aggregate a domain's map data delivered as an iterable of byte chunks
+    and publish the result. Raises ValueError or KeyError on invalid data."""
+    started = time.time()
+    (nodes, gateways, clients), counts, loads = parse_nodes(bot, domain, chunks)
+    domain.parse_seconds = time.time() - started
+    domain.status = (nodes, gateways, clients)
+    domain.counts = counts
+    domain.distribution = rank_counts(counts)
+    previous, domain.gateways = domain.gateways, loads
+    if domain.highscore is not None:
+        update_highscore(bot, domain.highscore, nodes, clients)
+    announce_node_changes(bot, domain)
+    announce_new_nodes(bot, domain)
+    announce_lost_gateways(bot, domain, previous)
+    domain.nodes.clear_changes()
+
+
+def back_off(name, state, stats, error):
+    """Delay the next poll exponentially while the map server is failing
+    or serving invalid data."""
+    stats['failed'] += 1
+    state['failures'] = state.get('failures', 0) + 1
+    delay = min(POLL_INTERVAL * 2 ** (state['failures'] - 1), MAX_BACKOFF)
+    state['retry_at'] = time.time() + delay
+    print('Warning: Unable to fetch map data of {} ({}), retrying in {} s.'.format(
+        name, error, delay))
+
+
+def parse_nodes(bot, domain, chunks):
+    info = domain.fetch
+    if config_bool(bot.config.freifunk.ffmap_streaming, True):
+        records = iter_map(chunks, info)
+    else:
+        records = iter_document(json.loads(b''.join(chunks).decode('utf-8')), info)
+
+    index = domain.nodes
+    index.begin(clock(),
+                int(bot.config.freifunk.flap_window or 30 * 60),
+                int(bot.config.freifunk.flap_threshold or 4))
+    counts = dict((name, {}) for name in DISTRIBUTIONS)
+    loads = {}
+    result = aggregate(records, index, counts, loads)
+    index.finish()
+    return result, counts, loads
+
+
+def rank_counts(counts):
+    """Sort the counters of every distribution into (value, nodes) lists,
+    the most common value first."""
+    return dict((name, sorted(values.items(), key=lambda item: (-item[1], repr(item[0]))))
+                for name, values in counts.items())
+
+
+def merge_counts(domains):
+    counts = dict((name, {}) for name in DISTRIBUTIONS)
+    for domain in domains:
+        for name, values in domain.counts.items():
+            merged = counts[name]
+            for value, nodes in values.items():
+                merged[value] = merged.get(value, 0) + nodes
+    return counts
+
+
+def aggregate(records, index=None, counts=None, gateways=None):
+    """Count online nodes, distinct gateways and clients of an iterable of
+    node records, updating the NodeIndex if one is given. If counts is given,
+    the online nodes per value of each of its DISTRIBUTIONS are added to it.
+    If gateways is given, it is filled with [nodes, clients] per gateway."""
+    loads = {} if gateways is None else gateways
     nodes = 0
     clients = 0
-    for node in mapdata['nodes']:
+    if counts is not None:
+        firmwares, models, branches = (counts[name] for name in DISTRIBUTIONS)
+    for (node_id, hostname, online, node_clients, gateway, mac, lat, lon,
+         firmware, model, branch) in records:
+        if index is not None and node_id:
+            index.update(node_id, hostname, online, node_clients, gateway, mac, lat, lon)
+        if not online:
+            continue
+
+        nodes += 1
+        clients += node_clients
+        if gateway:
+            load = loads.get(gateway)
+            if load is None:
+                loads[gateway] = [1, node_clients]
+            else:
+                load[0] += 1
+                load[1] += node_clients
+        if counts is not None:
+            firmwares[firmware] = firmwares.get(firmware, 0) + 1
+            models[model] = models.get(model, 0) + 1
+            branches[branch] = branches.get(branch, 0) + 1
+
+    return nodes, len(loads), clients
+
+
+class NodeIndex(object):
+    """
+    State of every node seen so far, kept in parallel arrays indexed by a
+    slot per node. Slots are never freed, so a poll only appends new nodes
+    and updates the others in place.
+
+    Between begin() and finish() each node of the map data is passed to
+    update(), which records the nodes whose online state changed. Nodes that
+    disappear from the map data count as offline. The changes and new nodes
+    are kept until clear_changes(), so those of a poll that failed halfway
+    are announced with the next one. New and renamed nodes are added to the
+    search index as they are seen, and nodes with a location are kept in a
+    grid of GRID_SIZE degrees for queries by distance.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.names = {}
+        self.search = NodeSearch()
+        self.grid = {}
+        self.ids = []
+        self.hostnames = []
+        self.macs = []
+        self.latitude = array(str('d'))
+        self.longitude = array(str('d'))
+        self.cells = []
+        self.gateways = []
+        self.online = bytearray()
+        self.clients = array(str('I'))
+        self.last_seen = array(str('d'))
+        self.seen = array(str('L'))
+        self.generation = 0
+        self.now = 0
+        self.appeared = []
+        self.flapping = {}
+        self.new_flapping = []
+        self._changes = {}
+        # the new online state of nodes that changed since clear_changes()
+        self._pending = {}
+        self._flap_window = 0
+        self._flap_threshold = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def dump(self):
+        """Return the node state as a dict of plain values and a list of
+        (name, bytes) columns, for save_state()."""
+        located = bytearray(0 if cell is None else 1 for cell in self.cells)
+        columns = [('online', bytes(self.online)), ('located', bytes(located))]
+        for name in INDEX_ARRAYS:
+            columns.append((name, array_bytes(getattr(self, name))))
+        for name in INDEX_STRINGS:
+            columns.append((name, '\0'.join(value or '' for value in getattr(self, name))
+                            .encode('utf-8')))
+        meta = {
+            'nodes': len(self),
+            'generation': self.generation,
+            'now': self.now,
+            'byteorder': sys.byteorder,
+            'itemsize': dict((name, getattr(self, name).itemsize) for name in INDEX_ARRAYS),
+        }
+        return meta, columns
+
+    @classmethod
+    def restore(cls, meta, columns):
+        """Rebuild an index from the output of dump(), including the search
+        index and grid. Raises ValueError if the columns do not fit."""
+        index = cls()
+        count = meta['nodes']
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError('saved with a different byte order')
+        for name in INDEX_ARRAYS:
+            values = getattr(index, name)
+            if meta['itemsize'][name] != values.itemsize:
+                raise ValueError('saved with a different size of {}'.format(name))
+            setattr(index, name, array_from(values.typecode, columns[name]))
+        for name in INDEX_STRINGS:
+            values = columns[name].decode('utf-8').split('\0') if count else []
+            setattr(index, name, [value or None for value in values])
+        index.online = bytearray(columns['online'])
+        located = bytearray(columns['located'])
+        for name in ('online',) + INDEX_ARRAYS + INDEX_STRINGS:
+            if len(getattr(index, name)) != count or len(located) != count:
+                raise ValueError('truncated column {}'.format(name))
+
+        index.generation = meta['generation']
+        index.now = meta['now']
+        index.cells = [None] * count
+        for slot, node_id in enumerate(index.ids):
+            index.slots[node_id] = slot
+            index._index(slot)
+            if located[slot]:
+                index._locate(slot, index.latitude[slot], index.longitude[slot])
+        index.search.flush()
+        return index
+
+    def begin(self, now, flap_window, flap_threshold):
+        self.generation += 1
+        self.now = now
+        self._flap_window = flap_window
+        self._flap_threshold = flap_threshold
+
+    @property
+    def went_online(self):
+        return [slot for slot, online in self._pending.items() if online]
+
+    @property
+    def went_offline(self):
+        return [slot for slot, online in self._pending.items() if not online]
+
+    def clear_changes(self):
+        """Forget the changes, once they were announced."""
+        self._pending.clear()
+        del self.appeared[:]
+        del self.new_flapping[:]
+
+    def update(self, node_id, hostname, online, clients, gateway, mac=None,
+               latitude=None, longitude=None):
+        online = 1 if online else 0
+        slot = self.slots.get(node_id)
+        if slot is None:
+            slot = self.slots[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.hostnames.append(hostname)
+            self.macs.append(mac)
+            self.gateways.append(gateway)
+            self.online.append(online)
+            self.clients.append(clients)
+            self.last_seen.append(self.now if online else 0)
+            self.seen.append(self.generation)
+            self.appeared.append(slot)
+            self.latitude.append(0)
+            self.longitude.append(0)
+            self.cells.append(None)
+            self._index(slot)
+            self._locate(slot, latitude, longitude)
+            return
+
+        if self.online[slot] != online:
+            self._changed(slot, online)
+        self.online[slot] = online
+        self.clients[slot] = clients
+        self.gateways[slot] = gateway
+        self.seen[slot] = self.generation
+        if online:
+            self.last_seen[slot] = self.now
+        if hostname != self.hostnames[slot] or mac != self.macs[slot]:
+            self._unindex(slot)
+            self.hostnames[slot] = hostname
+            self.macs[slot] = mac
+            self._index(slot)
+        if latitude is not None or self.cells[slot] is not None:
+            self._locate(slot, latitude, longitude)
+
+    def _locate(self, slot, latitude, longitude):
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+            cell = grid_cell(latitude, longitude)
+        except (TypeError, ValueError):
+            cell = None
+        if cell == self.cells[slot]:
+            if cell is None or (self.latitude[slot] == latitude and
+                                self.longitude[slot] == longitude):
+                return
+        else:
+            if self.cells[slot] is not None:
+                self.grid[self.cells[slot]].discard(slot)
+            if cell is not None:
+                self.grid.setdefault(cell, set()).add(slot)
+            self.cells[slot] = cell
+        if cell is not None:
+            self.latitude[slot] = latitude
+            self.longitude[slot] = longitude
+
+    def _search_keys(self, slot):
+        hostname = (self.hostnames[slot] or '').lower()
+        keys = set([self.ids[slot].lower()])
+        if hostname:
+            keys.add(hostname)
+        if self.macs[slot]:
+            keys.add(normalize_mac(self.macs[slot]))
+        return hostname, keys
+
+    def _index(self, slot):
+        hostname, keys = self._search_keys(slot)
+        if hostname:
+            self.names[hostname] = slot
+        self.search.add(slot, hostname, keys)
+
+    def _unindex(self, slot):
+        hostname, keys = self._search_keys(slot)
+        if hostname and self.names.get(hostname) == slot:
+            del self.names[hostname]
+        self.search.remove(slot, hostname, keys)
+
+    def finish(self):
+        generation = self.generation
+        seen = self.seen
+        online = self.online
+        for slot in range(len(seen)):
+            if seen[slot] != generation and online[slot]:
+                online[slot] = 0
+                self.clients[slot] = 0
+                self._changed(slot, 0)
+        self.search.flush()
+
+        # nodes that were stable for a whole window stop flapping
+        for slot, changes in list(self._changes.items()):
+            while changes and changes[0] < self.now - self._flap_window:
+                changes.popleft()
+            if not changes:
+                del self._changes[slot]
+                self.flapping.pop(slot, None)
+
+    def _changed(self, slot, online):
+        changes = self._changes.setdefault(slot, deque())
+        changes.append(self.now)
+        while changes[0] < self.now - self._flap_window:
+            changes.popleft()
+
+        if len(changes) >= self._flap_threshold:
+            if slot not in self.flapping:
+                self.new_flapping.append(slot)
+                self._pending.pop(slot, None)
+            self.flapping[slot] = len(changes)
+        elif slot not in self.flapping:
+            # a second change before clear_changes() restores the state
+            # that was announced last
+            if self._pending.pop(slot, None) is None:
+                self._pending[slot] = online
+
+    def name(self, slot):
+        return self.hostnames[slot] or self.ids[slot]
+
+    def find(self, query):
+        """Return the slot of a node by hostname or node_id, or None."""
+        query = query.strip()
+        slot = self.names.get(query.lower())
+        if slot is None:
+            slot = self.slots.get(normalize_mac(query))
+        return slot
+
+    def lookup(self, query, limit=10):
+        """
+        Return up to limit slots of nodes matching query, exact matches
+        first, then prefixes of hostname, node_id or MAC, then hostnames
+        containing it. A true second value means there were more matches.
+        """
+        query = query.strip().lower()
+        found = []
+        seen = set()
+        exact = self.find(query)
+        candidates = [() if exact is None else (exact,), self.search.prefix(query)]
+        if normalize_mac(query) != query:
+            candidates.append(self.search.prefix(normalize_mac(query)))
+        candidates.append(self.search.substring(query, self.hostnames))
+        for slot in itertools.chain.from_iterable(candidates):
+            if slot in seen:
+                continue
+            if len(found) == limit:
+                return found, True
+            seen.add(slot)
+            found.append(slot)
+        return found, False
+
+
+    def near(self, latitude, longitude, radius):
+        """Return (distance, slot) of the nodes within radius metres, the
+        nearest first. Only the grid cells around the position are read."""
+        rows, cols = cell_span(latitude, radius)
+        row, col = grid_cell(latitude, longitude)
+        found = []
+        for r in range(row - rows, row + rows + 1):
+            for c in range(col - cols, col + cols + 1):
+                found.extend(self._distances(self.grid.get((r, c), ()), latitude, longitude))
+        return sorted(hit for hit in found if hit[0] <= radius)
+
+    def nearest(self, latitude, longitude, limit, max_distance):
+        """Return (distance, slot) of the limit nearest nodes up to
+        max_distance metres away, searching rings of cells outwards."""
+        row, col = grid_cell(latitude, longitude)
+        cell_metres = cell_size_metres(abs(latitude) + max_distance / DEGREE_METRES)
+        found = []
+        ring = 0
+        while ring * cell_metres <= max_distance:
+            cells = ((r, c) for r in range(row - ring, row + ring + 1)
+                     for c in range(col - ring, col + ring + 1)
+                     if max(abs(r - row), abs(c - col)) == ring)
+            for cell in cells:
+                found.extend(self._distances(self.grid.get(cell, ()), latitude, longitude))
+            found.sort()
+            # cells further out are at least ring cells away
+            if len(found) >= limit and found[limit - 1][0] <= ring * cell_metres:
+                break
+            ring += 1
+        return [hit for hit in found[:limit] if hit[0] <= max_distance]
+
+    def _distances(self, slots, latitude, longitude):
+        for slot in slots:
+            yield distance(latitude, longitude, self.latitude[slot], self.longitude[slot]), slot
+
+
+# columns of a NodeIndex written by dump(), besides online and located
+INDEX_ARRAYS = ('clients', 'last_seen', 'seen', 'latitude', 'longitude')
+INDEX_STRINGS = ('ids', 'hostnames', 'macs', 'gateways')
+
+
+def array_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def array_from(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+# edge of the cells of the node location grid in degrees, about 1 km
+GRID_SIZE = 0.01
+EARTH_RADIUS = 6371000.0
+DEGREE_METRES = math.radians(1) * EARTH_RADIUS
+
+
+def grid_cell(latitude, longitude):
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Invalid location')
+    return int(math.floor(latitude / GRID_SIZE)), int(math.floor(longitude / GRID_SIZE))
+
+
+def cell_size_metres(latitude):
+    """Shortest edge of the grid cells up to latitude, north or south."""
+    latitude = min(abs(latitude) + GRID_SIZE, 90)
+    return GRID_SIZE * DEGREE_METRES * max(math.cos(math.radians(latitude)), 1e-6)
+
+
+def cell_span(latitude, radius):
+    """Rows and columns of grid cells around a cell that cover radius."""
+    rows = int(math.ceil(radius / (GRID_SIZE * DEGREE_METRES)))
+    cols = int(math.ceil(radius / cell_size_metres(abs(latitude) + rows * GRID_SIZE)))
+    return rows, min(cols, int(360 / GRID_SIZE))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(a), 1))
+
+
+def normalize_mac(value):
+    return value.lower().replace(':', '').replace('-', '')
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class NodeSearch(object):
+    """
+    Search index over the nodes of a NodeIndex: a sorted list of (key, slot)
+    pairs answers prefix queries with a binary search, and a map of hostname
+    trigrams to slots narrows substring queries down to a few candidates.
+    Nodes are added and removed one at a time, as the poll sees them change;
+    new keys are merged into the sorted list by flush() at the end of a poll.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._pending = []
+        self._trigrams = {}
+
+    def add(self, slot, hostname, keys):
+        self._pending.extend((key, slot) for key in keys)
+        for gram in trigrams(hostname):
+            self._trigrams.setdefault(gram, set()).add(slot)
+
+    def remove(self, slot, hostname, keys):
+        self.flush()
+        for key in keys:
+            i = bisect.bisect_left(self._keys, (key, slot))
+            if i < len(self._keys) and self._keys[i] == (key, slot):
+                del self._keys[i]
+        for gram in trigrams(hostname):
+            slots = self._trigrams.get(gram)
+            if slots is not None:
+                slots.discard(slot)
+                if not slots:
+                    del self._trigrams[gram]
+
+    def flush(self):
+        if self._pending:
+            keys = self._keys + self._pending
+            keys.sort()
+            self._keys = keys
+            self._pending = []
+
+    def prefix(self, prefix):
+        """Yield the slots of keys starting with prefix, in key order."""
+        keys = self._keys
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            yield keys[i][1]
+            i += 1
+
+    def substring(self, text, hostnames):
+        """Return the slots whose hostname contains text, which needs to be
+        at least three characters long."""
+        grams = trigrams(text)
+        if not grams:
+            return []
+        if not all(gram in self._trigrams for gram in grams):
+            return []
+        sets = sorted((self._trigrams[gram] for gram in grams), key=len)
+        candidates = set(sets[0])
+        for other in sets[1:]:
+            candidates &= other
+            if not candidates:
+                return []
+        return sorted(slot for slot in candidates if text in hostnames[slot].lower())
+
+
+def announce(bot, msg, domain=None):
+    """Print msg and send it to the announce target, naming the domain it
+    is about if there are several."""
+    if domain is not None and len(bot.memory['ffda']['domains']) > 1:
+        msg = '[{}] {}'.format(domain.name, msg)
+    print(msg)
+    bot.msg(bot.config.freifunk.announce_target, msg)
+
+
+def announce_node_changes(bot, domain):
+    if not config_bool(bot.config.freifunk.announce_nodes, False):
+        return
+
+    index = domain.nodes
+    parts = []
+    for label, slots in (('Offline', index.went_offline),
+                         ('Wieder online', index.went_online)):
+        if slots:
+            parts.append('{}: {}'.format(label, format_nodes(index, slots)))
+    if index.new_flapping:
+        parts.append('Instabil: {}'.format(format_nodes(index, index.new_flapping)))
+
+    if parts:
+        msg = '. '.join(parts) + '.'
+        announce(bot, msg, domain)
+
+
+def announce_new_nodes(bot, domain):
+    """Register the nodes that are new to the index of a domain and
+    announce those never seen before in one message."""
+    index = domain.nodes
+    if not index.appeared:
+        return
+    registry = bot.memory['ffda']['registry']
+    with REGISTRY_LOCK:
+        new = registry.add(domain.name, [index.ids[slot] for slot in index.appeared], clock())
+    if not new or not config_bool(bot.config.freifunk.announce_new_nodes, True):
+        return
+
+    msg = 'Neue Nodes: {}.'.format(format_nodes(index, [index.slots[node_id] for node_id in new]))
+    if len(new) == 1:
+        msg = 'Neuer Node: {}.'.format(index.name(index.slots[new[0]]))
+    announce(bot, msg, domain)
+
+
+def announce_partitions(bot, domain, previous):
+    """Announce nodes that lost their uplink since the previous graph."""
+    if previous is None or not config_bool(bot.config.freifunk.announce_partitions, False):
+        return
+    isolated = set(itertools.chain.from_iterable(domain.mesh.islands))
+    lost = isolated - set(itertools.chain.from_iterable(previous.islands))
+    if not lost:
+        return
+
+    msg = '{} Knoten ohne Uplink in {} {}, neu: {}.'.format(
+        len(isolated), len(domain.mesh.islands),
+        'Insel' if len(domain.mesh.islands) == 1 else 'Inseln',
+        format_graph_nodes(domain, lost))
+    announce(bot, msg, domain)
+
+
+def format_graph_nodes(domain, keys, limit=10):
+    """Names of the nodes of a link graph, by the index where known."""
+    index = domain.nodes
+    names = sorted(index.name(index.slots[key]) if key in index.slots else key
+                   for key in keys)
+    text = ', '.join(names[:limit])
+    if len(names) > limit:
+        text += ' (+{} weitere)'.format(len(names) - limit)
+    return text
+
+
+def announce_lost_gateways(bot, domain, previous):
+    """Announce gateways that served at least gateway_alert_nodes nodes in
+    the previous poll and none in this one."""
+    threshold = int(bot.config.freifunk.gateway_alert_nodes or 20)
+    if not threshold or not previous:
+        return
+
+    current = domain.gateways
+    lost = sorted(((gateway, load) for gateway, load in previous.items()
+                   if load[0] >= threshold and gateway not in current),
+                  key=lambda item: -item[1][0])
+    if not lost:
+        return
+
+    parts = ['{} (zuletzt {} Nodes, {} Clients)'.format(gateway, nodes, clients)
+             for gateway, (nodes, clients) in lost]
+    msg = '{}: {}.'.format('Gateway weggefallen' if len(lost) == 1 else 'Gateways weggefallen',
+                           ', '.join(parts))
+    announce(bot, msg, domain)
+
+
+def gateway_imbalance(loads):
+    """Nodes of the busiest gateway relative to the average, 1.0 when the
+    nodes are spread evenly."""
+    if not loads:
+        return 0.0
+    nodes = [load[0] for load in loads.values()]
+    return max(nodes) * len(nodes) / float(sum(nodes))
+
+
+def merge_loads(domains):
+    loads = {}
+    for domain in domains:
+        for gateway, (nodes, clients) in domain.gateways.items():
+            load = loads.setdefault(gateway, [0, 0])
+            load[0] += nodes
+            load[1] += clients
+    return loads
+
+
+def format_nodes(index, slots, limit=10):
+    names = sorted(index.name(slot) for slot in slots)
+    text = ', '.join(names[:limit])
+    if len(names) > limit:
+        text += ' (+{} weitere)'.format(len(names) - limit)
+    return text
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class JSONStream(object):
+    """
+    Incrementally decode a JSON document from an iterable of byte chunks.
+
+    Only the value currently asked for has to fit into the buffer, so a large
+    array can be walked element by element without materialising it.
+    """
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _number_start = '-0123456789'
+    _number_tail = re.compile(r'[0-9.eE+-]*\Z')
+
+    def __init__(self, chunks, encoding='utf-8'):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Append the next chunk to the buffer, False if there is none."""
+        if self._eof:
+            return False
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._buf = self._buf[self._pos:] + text
+                self._pos = 0
+                return True
+        self._eof = True
+        text = self._decoder.decode(b'', True)
+        if text:
+            self._buf = self._buf[self._pos:] + text
+            self._pos = 0
+            return True
+        return False
+
+    def peek(self):
+        """Return the next non-whitespace character, '' at the end."""
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at offset {}'.format(char, self._pos))
+        self._pos += 1
+
+    def value(self):
+        """Decode and return the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number could continue in the next chunk, even where a
+            # shorter one was decoded from e.g. '1.' or '1.5e'
+            if (self._buf[self._pos] in self._number_start and
+                    self._number_tail.match(self._buf, end) and self._fill()):
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        """Yield the elements of the next array, or the values of the next
+        object, one at a time."""
+        opening = self.peek()
+        if opening == '[':
+            close, keyed = ']', False
+        elif opening == '{':
+            close, keyed = '}', True
+        else:
+            raise ValueError('Expected array or object at offset {}'.format(self._pos))
+        self._pos += 1
+        if self.peek() == close:
+            self._pos += 1
+            return
+        while True:
+            if keyed:
+                self.value()
+                self.expect(':')
+            yield self.value()
+            if self.peek() != ',':
+                break
+            self._pos += 1
+        self.expect(close)
+
+    def skip(self):
+        """Consume the next value, decoding containers element by element."""
+        if self.peek() in ('[', '{'):
+            for _ in self.items():
+                pass
+        else:
+            self.value()
+
+    def members(self):
+        """Yield the keys of the next object. The caller has to consume the
+        value of each key before asking for the next one."""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() != ',':
+                break
+            self._pos += 1
+        self.expect('}')
+
+
+# Every map format is turned into node records of these fields
+NODE_FIELDS = ('node_id', 'hostname', 'online', 'clients', 'gateway', 'mac',
+               'latitude', 'longitude', 'firmware', 'model', 'branch')
+
+
+def autoupdater_branch(autoupdater):
+    """The autoupdater branch of a node, False if it is disabled."""
+    if not autoupdater:
+        return None
+    return autoupdater.get('branch') if autoupdater.get('enabled') else False
+
+
+def adapt_ffmap(entries):
+    """Node entries of the ffmap-backend nodes.json, version 1 and 2."""
+    for node in entries:
+        flags = node.get('flags')
+        if not flags:
+            continue
+        nodeinfo = node.get('nodeinfo') or {}
+        statistics = node.get('statistics') or {}
+        network = nodeinfo.get('network') or {}
+        location = nodeinfo.get('location') or {}
+        software = nodeinfo.get('software') or {}
+        hardware = nodeinfo.get('hardware') or {}
+        yield (nodeinfo.get('node_id'), nodeinfo.get('hostname'), bool(flags.get('online')),
+               statistics.get('clients') or 0, statistics.get('gateway'), network.get('mac'),
+               location.get('latitude'), location.get('longitude'),
+               (software.get('firmware') or {}).get('release'), hardware.get('model'),
+               autoupdater_branch(software.get('autoupdater')))
+
+
+def adapt_meshviewer(entries):
+    """Node entries of a meshviewer.json."""
+    for node in entries:
+        location = node.get('location') or {}
+        yield (node.get('node_id'), node.get('hostname'), bool(node.get('is_online')),
+               node.get('clients') or 0, node.get('gateway'), node.get('mac'),
+               location.get('latitude'), location.get('longitude'),
+               (node.get('firmware') or {}).get('release'), node.get('model'),
+               autoupdater_branch(node.get('autoupdater')))
+
+
+def adapt_graph(entries):
+    """Node entries of a graph.json, which only lists nodes in the mesh."""
+    for node in entries:
+        yield (node.get('node_id') or node.get('id'), None, True, 0, None, node.get('id'),
+               None, None, None, None, None)
+
+
+MAP_FORMATS = {
+    'nodes_v1': adapt_ffmap,
+    'nodes_v2': adapt_ffmap,
+    'meshviewer': adapt_meshviewer,
+    'graph': adapt_graph,
+}
+
+
+def detect_format(first, keyed):
+    """Name the map format from the first node entry."""
+    if keyed:
+        return 'nodes_v1'
+    if 'flags' in first:
+        return 'nodes_v2'
+    if 'is_online' in first:
+        return 'meshviewer'
+    raise ValueError('Unknown map format')
+
+
+def adapt_nodes(entries, keyed, info, graph=False):
+    """Detect the format once and hand all entries to its adapter."""
+    entries = iter(entries)
+    for first in entries:
+        info['format'] = 'graph' if graph else detect_format(first, keyed)
+        return MAP_FORMATS[info['format']](itertools.chain((first,), entries))
+    return iter(())
+
+
+def iter_map(chunks, info):
+    """Yield the node records of a map document delivered as byte chunks,
+    decoding one node at a time. The detected format is put into info."""
+    stream = JSONStream(chunks)
+    found = False
+    for key in stream.members():
+        if key == 'nodes':
+            found = True
+            keyed = stream.peek() == '{'
+            for record in adapt_nodes(stream.items(), keyed, info):
+                yield record
+        elif key == 'batadv':
+            for key in stream.members():
+                if key == 'nodes':
+                    found = True
+                    for record in adapt_nodes(stream.items(), False, info, graph=True):
+                        yield record
+                else:
+                    stream.skip()
+        else:
+            stream.skip()
+    if not found:
+        raise ValueError("No nodes in map data")
+
+
+def iter_document(document, info):
+    """Yield the node records of a completely decoded map document."""
+    if 'batadv' in document:
+        return adapt_nodes(document['batadv'].get('nodes', ()), False, info, graph=True)
+    nodes = document['nodes']
+    if isinstance(nodes, dict):
+        return adapt_nodes(nodes.values(), True, info)
+    return adapt_nodes(nodes, False, info)
+
+
+STATE_MAGIC = b'FFDAST01'
+# a saved status older than this is not served after a restart
+STATE_MAX_AGE = 15 * 60
+
+
+def state_file(bot, name):
+    """A file in state_dir, or next to the database by default."""
+    directory = bot.config.freifunk.state_dir or os.path.dirname(bot.db.filename)
+    return os.path.join(os.path.expanduser(directory), name)
+
+
+def state_path(bot, domain):
+    return state_file(bot, 'ffda-state-{}.bin'.format(domain.name))
+
+
+def save_state(bot, domain):
+    """
+    Write the aggregate and node index of a domain, replacing the previous
+    file at once. The file is a JSON header followed by the raw columns of
+    the index, so loading it needs no parsing per node.
+    """
+    meta, columns = domain.nodes.dump()
+    header = json.dumps({
+        'saved': clock(),
+        'status': domain.status,
+        'counts': dict((name, list(values.items())) for name, values in domain.counts.items()),
+        'gateways': domain.gateways,
+        'fetch': dict((key, domain.fetch.get(key))
+                      for key in ('etag', 'last_modified', 'digest', 'format')),
+        'index': meta,
+        'columns': [(name, len(data)) for name, data in columns],
+    }).encode('utf-8')
+
+    path = state_path(bot, domain)
+    with open(path + '.tmp', 'wb') as state:
+        state.write(STATE_MAGIC)
+        state.write(struct.pack(str('<I'), len(header)))
+        state.write(header)
+        for _, data in columns:
+            state.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def load_state(bot, domain):
+    """
+    Restore the node index of a domain from its state file, and its status
+    if it was saved recently, in which case the fetch validators are kept so
+    that the first poll can be answered with 304 Not Modified.
+    """
+    path = state_path(bot, domain)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as state:
+            mapped = mmap.mmap(state.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            if not node['flags']['online']:
+            if mapped[:len(STATE_MAGIC)] != STATE_MAGIC:
+                raise ValueError('not a state file')
+            offset = len(STATE_MAGIC) + 4
+            length, = struct.unpack(str('<I'), mapped[offset - 4:offset])
+            header = json.loads(mapped[offset:offset + length].decode('utf-8'))
+            offset += length
+            columns = {}
+            for name, size in header['columns']:
+                columns[name] = mapped[offset:offset + size]
+                offset += size
+            if offset > len(mapped):
+                raise ValueError('truncated')
+            index = NodeIndex.restore(header['index'], columns)
+        finally:
+            mapped.close()
+    except (EnvironmentError, ValueError, KeyError, TypeError, struct.error) as e:
+        print('Warning: Ignoring the saved state of {} ({}).'.format(domain.name, e))
+        return False
+
+    domain.nodes = index
+    if header['status'] and clock() - header['saved'] <= STATE_MAX_AGE:
+        domain.status = tuple(header['status'])
+        domain.counts = dict((name, dict((value, nodes) for value, nodes in pairs))
+                             for name, pairs in header['counts'].items())
+        domain.distribution = rank_counts(domain.counts)
+        domain.gateways = header['gateways']
+        domain.fetch.update((key, value) for key, value in header['fetch'].items()
+                            if value is not None)
+    return True
+
+
+# a segment file per domain and day, each with an index of its records
+ARCHIVE_RECORD = struct.Struct(str('<dBI'))
+ARCHIVE_INDEX = struct.Struct(str('<dQB'))
+KEYFRAME, DELTA = 1, 2
+# seconds between full snapshots, deltas are applied to the last one
+ARCHIVE_KEYFRAME_INTERVAL = 60 * 60
+# snapshots waiting for the writer, more are dropped
+ARCHIVE_BACKLOG = 4
+
+
+def archive_name(directory, domain, timestamp):
+    day = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+    return os.path.join(directory, 'ffda-archive-{}-{}.seg'.format(domain, day))
+
+
+def entry_id(entry):
+    """The node_id of a node entry of any map format."""
+    return ((entry.get('nodeinfo') or {}).get('node_id') or entry.get('node_id') or
+            entry.get('id'))
+
+
+def document_entries(document):
+    """Return the node entries of a decoded map document by node_id."""
+    if 'batadv' in document:
+        entries = document['batadv'].get('nodes', ())
+    else:
+        entries = document['nodes']
+        if isinstance(entries, dict):
+            entries = entries.values()
+    return dict((entry_id(entry), entry) for entry in entries if entry_id(entry))
+
+
+class SnapshotArchive(threading.Thread):
+    """
+    Appends the map data of every full poll to compressed segment files.
+    A record holds either a keyframe of all node entries or the keys of the
+    node entries that changed since the previous snapshot. Only a hash per
+    key of every node is remembered between snapshots. Decoding and writing
+    happen on this thread; a snapshot is dropped if the writer falls behind.
+    """
+
+    def __init__(self, directory, keyframe_interval=ARCHIVE_KEYFRAME_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.keyframe_interval = keyframe_interval
+        self.jobs = Queue.Queue(ARCHIVE_BACKLOG)
+        # per domain: segment name, time of the last keyframe, node hashes
+        self.segments = {}
+        self.previous = {}
+        self.dropped = 0
+
+    def submit(self, domain, timestamp, chunks):
+        try:
+            self.jobs.put_nowait((domain, timestamp, chunks))
+        except Queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            domain, timestamp, chunks = job
+            try:
+                document = json.loads(b''.join(chunks).decode('utf-8'))
+                self.write(domain, timestamp, document_entries(document))
+            except Exception:
+                print(traceback.format_exc())
+
+    def write(self, domain, timestamp, entries):
+        path = archive_name(self.directory, domain, timestamp)
+        segment, keyframe_at = self.segments.get(domain, (None, 0))
+        previous = self.previous.get(domain)
+        keyframe = (path != segment or previous is None or
+                    timestamp - keyframe_at >= self.keyframe_interval)
+
+        hashes = {}
+        changed = {}
+        removed = {}
+        for node_id, entry in entries.items():
+            # repr() depends on the order of the keys, which map servers keep
+            keys = tuple(entry)
+            values = array(str('q'), (hash(repr(entry[key])) for key in keys))
+            hashes[node_id] = keys, values
+            if keyframe:
                 continue
-            if 'gateway' in node['statistics']:
-                gateway_set.add(node['statistics']['gateway'])
-        except KeyError:
+            old_keys, old_values = previous.get(node_id, ((), ()))
+            old = dict(zip(old_keys, old_values))
+            fields = dict((key, entry[key]) for key, value in zip(keys, values)
+                          if old.get(key) != value)
+            if fields:
+                changed[node_id] = fields
+            gone_keys = [key for key in old_keys if key not in entry]
+            if gone_keys:
+                removed[node_id] = gone_keys
+
+        if keyframe:
+            kind, record = KEYFRAME, {'nodes': entries}
+        else:
+            gone = [node_id for node_id in previous if node_id not in entries]
+            kind, record = DELTA, {'changed': changed, 'removed': removed, 'gone': gone}
+        data = zlib.compress(json.dumps(record, separators=(',', ':')).encode('utf-8'), 6)
+
+        with open(path, 'ab') as seg:
+            offset = seg.tell()
+            seg.write(ARCHIVE_RECORD.pack(timestamp, kind, len(data)))
+            seg.write(data)
+        with open(path[:-4] + '.idx', 'ab') as idx:
+            idx.write(ARCHIVE_INDEX.pack(timestamp, offset, kind))
+
+        self.previous[domain] = hashes
+        if keyframe:
+            self.segments[domain] = path, timestamp
+
+
+def read_archive_index(path):
+    with open(path[:-4] + '.idx', 'rb') as idx:
+        data = idx.read()
+    size = ARCHIVE_INDEX.size
+    return [ARCHIVE_INDEX.unpack_from(data, i) for i in range(0, len(data) - size + 1, size)]
+
+
+def reconstruct_snapshot(directory, domain, when):
+    """
+    Return (timestamp, entries by node_id) of the last archived snapshot of
+    a domain at or before when, or None. Reads the index of the segment of
+    that day, then applies the deltas after the closest keyframe.
+    """
+    for days in range(2):
+        path = archive_name(directory, domain, when - days * 86400)
+        if not os.path.exists(path):
             continue
+        index = read_archive_index(path)
+        position = bisect.bisect_right([record[0] for record in index], when) - 1
+        if position < 0:
+            continue
+        start = position
+        while index[start][2] != KEYFRAME:
+            start -= 1
+
+        entries = {}
+        with open(path, 'rb') as seg:
+            seg.seek(index[start][1])
+            for _ in range(start, position + 1):
+                timestamp, kind, length = ARCHIVE_RECORD.unpack(seg.read(ARCHIVE_RECORD.size))
+                record = json.loads(zlib.decompress(seg.read(length)).decode('utf-8'))
+                if kind == KEYFRAME:
+                    entries = record['nodes']
+                    continue
+                for node_id, fields in record['changed'].items():
+                    entries.setdefault(node_id, {}).update(fields)
+                for node_id, keys in record['removed'].items():
+                    for key in keys:
+                        entries[node_id].pop(key, None)
+                for node_id in record['gone']:
+                    entries.pop(node_id, None)
+        return timestamp, entries
+    return None
+
+
+class NodeRegistry(object):
+    """
+    Every node_id ever seen with the time it was first seen, kept in a dict
+    and in a file that new nodes are appended to, one line each. When the
+    registry starts out empty, the first poll of every domain only fills
+    it, so that a new installation does not announce the whole mesh.
+    """
 
-        nodes += 1
+    def __init__(self, path, domains):
+        self.path = path
+        self.first_seen = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as registry:
+                for line in registry:
+                    node_id, _, timestamp = line.decode('utf-8').partition('\t')
+                    try:
+                        self.first_seen.setdefault(node_id, float(timestamp))
+                    except ValueError:
+                        pass  # cut off by a crash while appending
+        self.bootstrap = set() if self.first_seen else set(domains)
+
+    def __contains__(self, node_id):
+        return node_id in self.first_seen
+
+    def __len__(self):
+        return len(self.first_seen)
+
+    def add(self, domain, node_ids, now):
+        """Register node_ids, returning those that were not known yet,
+        unless the registry is being filled for domain."""
+        new = [node_id for node_id in node_ids if node_id not in self.first_seen]
+        for node_id in new:
+            self.first_seen[node_id] = now
+        if new and self.path is not None:
+            lines = ''.join('{}\t{}\n'.format(node_id, now) for node_id in new)
+            with open(self.path, 'ab') as registry:
+                registry.write(lines.encode('utf-8'))
+        if domain in self.bootstrap:
+            self.bootstrap.discard(domain)
+            return []
+        return new
+
+
+def open_registry(bot, domains):
+    path = None
+    if config_bool(bot.config.freifunk.persist_state, True):
+        path = state_file(bot, 'ffda-nodes.txt')
+    return NodeRegistry(path, domains)
+
+
+# resolution of past days in the uptime history, and how long it is kept
+UPTIME_SLOT = 15 * 60
+UPTIME_SLOTS = 86400 // UPTIME_SLOT
+UPTIME_DAY_BYTES = UPTIME_SLOTS // 8
+UPTIME_DAYS = 366
+UPTIME_MAGIC = b'FFDAUP01'
+# nodes in the daily report of the least reliable ones
+UPTIME_REPORT = 5
+
+
+def bits_int(data):
+    """A byte string as a number, its first bit the most significant."""
+    return int(binascii.hexlify(bytes(data)), 16) if data else 0
+
+
+def popcount(value):
+    return bin(value).count('1')
+
+
+class Uptime(object):
+    """
+    Online history of the nodes of a domain. Every poll of the day sets one
+    bit per online node in a bytearray per node. At midnight each node's
+    bits are folded into one bit per UPTIME_SLOT and appended to its
+    history; a year of 5k nodes takes about 22 MB. A slot's bit is set when
+    the node was online in at least half of its polls, counting the share
+    left over from rounding the previous slots, so that the bits of a
+    flapping node add up to the time it was online. Availability is the
+    popcount of a node's bits over the popcount of the observed slots, the
+    ones the bot actually polled, since the node was first seen.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.ids = []
+        self.since = array(str('d'))
+        self.history = []
+        self.days = []
+        self.observed = []
+        self.day = None
+        self.poll_slots = bytearray()
+        self.today = []
+        self.first_poll = array(str('l'))
+        self.report = []
+        self._map = []
+
+    def add(self, now, index):
+        """Record the online state of the nodes of a NodeIndex at a poll."""
+        day = date.fromtimestamp(now).toordinal()
+        if self.day is None:
+            self.day = day
+        elif day != self.day:
+            self.rotate(day)
+
+        poll = len(self.poll_slots)
+        self.poll_slots.append(day_slot(now))
+        for index_slot in range(len(self._map), len(index)):
+            self._map.append(self._slot(index.ids[index_slot], now, poll))
+
+        byte, bit = poll >> 3, 0x80 >> (poll & 7)
+        today = self.today
+        mapping = self._map
+        for index_slot in itertools.compress(range(len(index.online)), index.online):
+            bits = today[mapping[index_slot]]
+            if len(bits) <= byte:
+                bits.extend(bytearray(byte + 1 - len(bits)))
+            bits[byte] |= bit
+
+    def _slot(self, node_id, now, poll):
+        slot = self.slots.get(node_id)
+        if slot is None:
+            slot = self.slots[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.since.append(now)
+            self.history.append(bytearray(len(self.days) * UPTIME_DAY_BYTES))
+            self.today.append(bytearray())
+            self.first_poll.append(poll)
+        return slot
+
+    def rotate(self, day):
+        """Fold today's polls into the history and start the given day.
+        Keeps the availability of the folded day per node in report."""
+        polls = len(self.poll_slots)
+        width = (polls + 7) // 8
+        masks = [0] * UPTIME_SLOTS
+        for poll, slot in enumerate(self.poll_slots):
+            masks[slot] |= 1 << (width * 8 - 1 - poll)
+        observed = 0
+        for slot, mask in enumerate(masks):
+            if mask:
+                observed |= 1 << (UPTIME_SLOTS - 1 - slot)
+        every_poll = sum(masks)
+        counts = [popcount(mask) for mask in masks]
+
+        self.report = []
+        for slot, bits in enumerate(self.today):
+            value = bits_int(bytes(bits).ljust(width, b'\0'))
+            if not value:
+                folded = 0
+            elif value == every_poll:
+                folded = observed
+            else:
+                folded = 0
+                # the share not rounded away carries over to the next slot
+                carry = 0.0
+                for i, mask in enumerate(masks):
+                    if mask:
+                        carry += popcount(value & mask) / float(counts[i])
+                        if carry >= 0.5:
+                            folded |= 1 << (UPTIME_SLOTS - 1 - i)
+                            carry -= 1
+            self.history[slot].extend(binascii.unhexlify('{:0{}x}'.format(
+                folded, UPTIME_DAY_BYTES * 2)))
+            if value and self.first_poll[slot] == 0:
+                self.report.append((popcount(value) / float(polls), slot))
+
+        self.days.append(self.day)
+        self.observed.append(observed)
+        # days the bot did not run at all
+        for missed in range(self.day + 1, min(day, self.day + UPTIME_DAYS)):
+            self.days.append(missed)
+            self.observed.append(0)
+            for history in self.history:
+                history.extend(bytearray(UPTIME_DAY_BYTES))
+        drop = len(self.days) - UPTIME_DAYS
+        if drop > 0:
+            del self.days[:drop]
+            del self.observed[:drop]
+            for history in self.history:
+                del history[:drop * UPTIME_DAY_BYTES]
+
+        self.day = day
+        self.poll_slots = bytearray()
+        self.today = [bytearray() for _ in self.ids]
+        self.first_poll = array(str('l'), [0] * len(self.ids))
+        self.report.sort()
+
+    def availability(self, node_id, now, window):
+        """Return the share of the last window seconds a node was online,
+        and the seconds it was observed, or None if it is unknown."""
+        slot = self.slots.get(node_id)
+        if slot is None:
+            return None
+        start = max(now - window, self.since[slot])
+
+        # today, one bit per poll
+        polls = len(self.poll_slots)
+        first = self.first_poll[slot]
+        first_slot = day_slot(start) if start >= day_start(now) else 0
+        while first < polls and self.poll_slots[first] < first_slot:
+            first += 1
+        width = (polls + 7) // 8 * 8
+        mask = ((1 << (polls - first)) - 1) << (width - polls) if polls > first else 0
+        value = bits_int(bytes(self.today[slot]).ljust(width // 8, b'\0'))
+        online = popcount(value & mask) * POLL_INTERVAL
+        total = popcount(mask) * POLL_INTERVAL
+
+        # earlier days, one bit per UPTIME_SLOT
+        if self.days:
+            start_day = date.fromtimestamp(start).toordinal()
+            offset = max(start_day - self.days[0], 0) * UPTIME_SLOTS
+            if start_day >= self.days[0]:
+                offset += day_slot(start)
+            bits = len(self.days) * UPTIME_SLOTS
+            if offset < bits:
+                observed = 0
+                for day_mask in self.observed:
+                    observed = observed << UPTIME_SLOTS | day_mask
+                mask = observed & ((1 << (bits - offset)) - 1)
+                online += popcount(bits_int(self.history[slot]) & mask) * UPTIME_SLOT
+                total += popcount(mask) * UPTIME_SLOT
+
+        if not total:
+            return None
+        return online / float(total), total
+
+    def save(self, path):
+        """Write the history to path, replacing it at once."""
+        width = (len(self.poll_slots) + 7) // 8
+        header = json.dumps({
+            'day': self.day,
+            'days': self.days,
+            'observed': ['{:x}'.format(mask) for mask in self.observed],
+            'ids': self.ids,
+            'since': list(self.since),
+            'first_poll': list(self.first_poll),
+            'poll_slots': list(self.poll_slots),
+        }).encode('utf-8')
+        with open(path + '.tmp', 'wb') as saved:
+            saved.write(UPTIME_MAGIC)
+            saved.write(struct.pack(str('<I'), len(header)))
+            saved.write(header)
+            for history, today in zip(self.history, self.today):
+                saved.write(history)
+                saved.write(bytes(today).ljust(width, b'\0'))
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a history written by save(). Raises ValueError if the file
+        is damaged."""
+        uptime = cls()
+        with open(path, 'rb') as saved:
+            mapped = mmap.mmap(saved.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            clients += node['statistics'].get('clients', 0)
-        except KeyError:
-            pass
+            if mapped[:len(UPTIME_MAGIC)] != UPTIME_MAGIC:
+                raise ValueError('not an uptime file')
+            offset = len(UPTIME_MAGIC) + 4
+            length, = struct.unpack(str('<I'), mapped[offset - 4:offset])
+            header = json.loads(mapped[offset:offset + length].decode('utf-8'))
+            offset += length
+            history = len(header['days']) * UPTIME_DAY_BYTES
+            width = (len(header['poll_slots']) + 7) // 8
+            if len(mapped) != offset + len(header['ids']) * (history + width):
+                raise ValueError('truncated')
+            for node_id in header['ids']:
+                uptime.history.append(bytearray(mapped[offset:offset + history]))
+                uptime.today.append(bytearray(mapped[offset + history:offset + history + width]))
+                offset += history + width
+        finally:
+            mapped.close()
+        uptime.day = header['day']
+        uptime.days = header['days']
+        uptime.observed = [int(mask, 16) for mask in header['observed']]
+        uptime.ids = header['ids']
+        uptime.slots = dict((node_id, slot) for slot, node_id in enumerate(uptime.ids))
+        uptime.since = array(str('d'), header['since'])
+        uptime.first_poll = array(str('l'), header['first_poll'])
+        # saved before slots went by the wall clock, past 96 on a DST change
+        uptime.poll_slots = bytearray(min(slot, UPTIME_SLOTS - 1)
+                                      for slot in header['poll_slots'])
+        return uptime
+
+
+def day_start(timestamp):
+    day = date.fromtimestamp(timestamp)
+    return time.mktime(day.timetuple())
+
+
+def day_slot(timestamp):
+    """The UPTIME_SLOT of the local day a timestamp falls into. It goes by
+    the wall clock, so days with a DST change still have UPTIME_SLOTS."""
+    moment = datetime.fromtimestamp(timestamp)
+    return (moment.hour * 3600 + moment.minute * 60 + moment.second) // UPTIME_SLOT
+
+
+def uptime_path(bot, domain):
+    return state_file(bot, 'ffda-uptime-{}.bin'.format(domain.name))
+
+
+def load_uptime(bot, domain):
+    path = uptime_path(bot, domain)
+    if not os.path.exists(path):
+        return
+    try:
+        domain.uptime = Uptime.load(path)
+    except (EnvironmentError, ValueError, KeyError, TypeError, struct.error) as e:
+        print('Warning: Ignoring the uptime history of {} ({}).'.format(domain.name, e))
+
 
-    bot.memory['ffda']['status'] = (nodes, len(gateway_set), clients)
+def save_uptime(bot, domain):
     try:
-        update_highscore(bot, nodes, len(gateway_set), clients)
-    except ValueError:
-        print('Warning: Unable to update highscore on closed shelve.')
-        print(traceback.format_exc())
+        domain.uptime.save(uptime_path(bot, domain))
+    except EnvironmentError as e:
+        print('Warning: Unable to save the uptime history of {} ({}).'.format(domain.name, e))
+
+
+def record_uptime(bot, domain):
+    """Add a poll to the uptime history, saving it and reporting the least
+    reliable nodes of the previous day when the day changed."""
+    uptime = domain.uptime
+    day = uptime.day
+    uptime.add(clock(), domain.nodes)
+    if day is None or uptime.day == day:
+        return
+
+    if config_bool(bot.config.freifunk.persist_state, True):
+        save_uptime(bot, domain)
+    if not config_bool(bot.config.freifunk.uptime_report, False):
+        return
+    worst = [(share, slot) for share, slot in uptime.report if share < 1][:UPTIME_REPORT]
+    if not worst:
+        return
+    index = domain.nodes
+    parts = []
+    for share, slot in worst:
+        index_slot = index.slots.get(uptime.ids[slot])
+        name = index.name(index_slot) if index_slot is not None else uptime.ids[slot]
+        parts.append('{} ({})'.format(name, format_percent(share)))
+    msg = 'Unzuverlässigste Nodes gestern: {}.'.format(', '.join(parts))
+    announce(bot, msg, domain)
 
 
-def update_highscore(bot, nodes, gateways, clients):
-    hs = bot.memory['ffda']['highscore']
+def format_percent(share):
+    return '{:.1f} %'.format(share * 100).replace('.', ',')
+
+
+def iter_graph(chunks):
+    """
+    Read the nodes and links of a graph.json (batadv.nodes and
+    batadv.links, links by position) or meshviewer.json (nodes and links,
+    links by node_id) delivered as byte chunks. Returns the node_id (or
+    interface MAC) of every node and (source, target, vpn) of every link.
+    """
+    nodes = []
+    links = []
+    stream = JSONStream(chunks)
+
+    def read(stream):
+        for key in stream.members():
+            if key == 'nodes':
+                for node in stream.items():
+                    nodes.append((node.get('nodeinfo') or {}).get('node_id') or
+                                 node.get('node_id') or node.get('id'))
+            elif key == 'links':
+                for link in stream.items():
+                    links.append((link.get('source'), link.get('target'),
+                                  bool(link.get('vpn') or link.get('type') == 'vpn')))
+            elif key == 'batadv':
+                read(stream)
+            else:
+                stream.skip()
+
+    read(stream)
+    if not nodes:
+        raise ValueError('No nodes in graph data')
+    return nodes, links
+
+
+class MeshPartition(object):
+    """Connected components of a link graph: how many there are and the
+    node keys of those without a VPN link, the largest first."""
+
+    def __init__(self, nodes, components, islands):
+        self.nodes = nodes
+        self.components = components
+        self.islands = islands
+
+
+def find_partitions(nodes, links):
+    """
+    Join the nodes of every link with union-find (union by size, path
+    halving) and collect the components that have no VPN link. Interfaces
+    of the same node are one element; links name nodes by position or key.
+    """
+    elements = {}
+    positions = array(str('l'))
+    for key in nodes:
+        positions.append(elements.setdefault(key, len(elements)))
+    parent = array(str('l'), range(len(elements)))
+    size = array(str('l'), [1]) * len(elements)
+    uplink = bytearray(len(elements))
+
+    def element(end):
+        if isinstance(end, int) and 0 <= end < len(positions):
+            return positions[end]
+        if end not in elements:
+            elements[end] = len(elements)
+            parent.append(elements[end])
+            size.append(1)
+            uplink.append(0)
+        return elements[end]
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for source, target, vpn in links:
+        a, b = element(source), element(target)
+        if vpn:
+            uplink[a] = uplink[b] = 1
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+
+    members = {}
+    connected = set()
+    for key, x in elements.items():
+        root = find(x)
+        members.setdefault(root, []).append(key)
+        if uplink[x]:
+            connected.add(root)
+    islands = sorted((sorted(keys) for root, keys in members.items() if root not in connected),
+                     key=lambda keys: (-len(keys), keys))
+    return MeshPartition(len(elements), len(members), islands)
+
+
+class MetricsServer(HTTPServer):
+    # rebind the port right after a restart
+    allow_reuse_address = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.bot.memory['ffda']['metrics']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(bot, address, port):
+    server = MetricsServer((address, port), MetricsHandler)
+    server.bot = bot
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop_metrics_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def render_metrics(bot):
+    """
+    Render the Prometheus text exposition of the current state. Scrapes are
+    answered with the stored result, so this only runs after a poll. The
+    metrics derived from the map data are only rendered again when some
+    domain fetched new data, the counters and timings after every poll.
+    """
+    ffda = bot.memory['ffda']
+    domains = list(ffda['domains'].values())
+    updates = sum(domain.updates for domain in domains)
+    lines = []
+
+    def metric(name, kind, text, samples):
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            if labels:
+                labels = '{' + ','.join('{}="{}"'.format(key, escape_label(value))
+                                        for key, value in labels) + '}'
+            lines.append('{}{} {}'.format(name, labels or '', value))
+
+    cached = ffda.get('metrics_state')
+    if cached is not None and cached[0] == updates:
+        lines.extend(cached[1])
+    else:
+        if 'status' in ffda:
+            for i, name in enumerate(('nodes', 'gateways', 'clients')):
+                metric('ffda_' + name, 'gauge', 'Online {} of all domains.'.format(name),
+                       [((), ffda['status'][i])])
+        for i, name in enumerate(('nodes', 'gateways', 'clients')):
+            metric('ffda_domain_' + name, 'gauge', 'Online {} per domain.'.format(name),
+                   [((('domain', d.name),), d.status[i]) for d in domains if d.status is not None])
+
+        metric('ffda_gateway_nodes', 'gauge', 'Online nodes per gateway.',
+               [((('domain', d.name), ('gateway', gateway)), load[0])
+                for d in domains for gateway, load in sorted(d.gateways.items())])
+        metric('ffda_gateway_clients', 'gauge', 'Clients of the online nodes per gateway.',
+               [((('domain', d.name), ('gateway', gateway)), load[1])
+                for d in domains for gateway, load in sorted(d.gateways.items())])
+        metric('ffda_gateway_imbalance', 'gauge',
+               'Nodes of the busiest gateway relative to the average.',
+               [((('domain', d.name),), '{:.6f}'.format(gateway_imbalance(d.gateways)))
+                for d in domains if d.gateways])
+
+        meshes = [d for d in domains if d.mesh is not None]
+        metric('ffda_mesh_components', 'gauge', 'Connected components of the link graph.',
+               [((('domain', d.name),), d.mesh.components) for d in meshes])
+        metric('ffda_mesh_islands', 'gauge', 'Components of the link graph without uplink.',
+               [((('domain', d.name),), len(d.mesh.islands)) for d in meshes])
+        metric('ffda_mesh_nodes_without_uplink', 'gauge', 'Nodes in components without uplink.',
+               [((('domain', d.name),), sum(len(island) for island in d.mesh.islands))
+                for d in meshes])
+        ffda['metrics_state'] = (updates, list(lines))
+
+    hs = ffda['highscore']
+    for key in ('nodes', 'clients'):
+        metric('ffda_highscore_' + key, 'gauge', 'All-time highscore of {}.'.format(key),
+               [((), hs[key])])
+        metric('ffda_daily_highscore_' + key, 'gauge', "Today's highscore of {}.".format(key),
+               [((), hs['daily_' + key])])
+
+    if ARCHIVE is not None:
+        metric('ffda_archive_dropped_total', 'counter',
+               'Snapshots not archived because the writer was busy.', [((), ARCHIVE.dropped)])
+
+    workers = getattr(bot, 'workers', None)
+    if workers is not None:
+        stats = workers.stats()
+        metric('willie_worker_queue_depth', 'gauge', 'Calls waiting for a worker.',
+               [((('priority', p),), stats['depth'][p]) for p in workers.priorities])
+        metric('willie_worker_running', 'gauge', 'Calls running on a worker.',
+               [((), stats['running'])])
+        metric('willie_worker_calls_total', 'counter', 'Calls by outcome.',
+               [((('result', key),), stats[key]) for key in ('completed', 'dropped')])
+        metric('willie_worker_wait_seconds_total', 'counter',
+               'Time calls waited for a worker.', [((), '{:.6f}'.format(stats['wait_total']))])
+        metric('willie_worker_wait_seconds_max', 'gauge',
+               'Longest time a call waited for a worker.',
+               [((), '{:.6f}'.format(stats['wait_max']))])
+
+    metric('ffda_fetches_total', 'counter', 'Map data fetches by result.',
+           [((('domain', d.name), ('result', key)), d.stats[key])
+            for d in domains for key in FETCH_STATS if key != 'bytes'])
+    metric('ffda_fetched_bytes_total', 'counter', 'Bytes of map data received.',
+           [((('domain', d.name),), d.stats['bytes']) for d in domains])
+    metric('ffda_fetch_size_bytes', 'gauge', 'Size of the last full fetch on the wire.',
+           [((('domain', d.name),), d.fetch_bytes) for d in domains])
+    metric('ffda_poll_duration_seconds', 'gauge', 'Duration of the last poll.',
+           [((('domain', d.name),), '{:.6f}'.format(d.poll_seconds)) for d in domains])
+    metric('ffda_parse_duration_seconds', 'gauge', 'Duration of the last aggregation.',
+           [((('domain', d.name),), '{:.6f}'.format(d.parse_seconds)) for d in domains])
+
+    ffda['metrics'] = ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# (seconds per step, number of steps): 15 s for a day, 5 min for a month,
+# 1 h and 1 d for five years
+HISTORY_TIERS = ((15, 5760), (5 * 60, 8640), (60 * 60, 43800), (86400, 1830))
+# the finest tier that needs no more rows than this answers a trend query,
+# so a query reads at most this many rows for windows up to 400 days
+TREND_MAX_ROWS = 400
+
+
+class Archive(object):
+    """
+    Round robin archive of (nodes, gateways, clients) samples, consolidated
+    into min/max/sum/count per step. Memory is allocated once up front.
+    """
+    metrics = 3
+
+    def __init__(self, step, rows):
+        self.step = step
+        self.rows = rows
+        self.slots = array(str('l'), [-1]) * rows
+        self.count = array(str('I'), [0]) * rows
+        self.min = array(str('I'), [0]) * (rows * self.metrics)
+        self.max = array(str('I'), [0]) * (rows * self.metrics)
+        self.sum = array(str('d'), [0]) * (rows * self.metrics)
+
+    @property
+    def span(self):
+        return self.step * self.rows
+
+    def add(self, timestamp, values):
+        slot = int(timestamp // self.step)
+        row = slot % self.rows
+        base = row * self.metrics
+        if self.slots[row] != slot:
+            self.slots[row] = slot
+            self.count[row] = 1
+            for i, value in enumerate(values):
+                self.min[base + i] = self.max[base + i] = value
+                self.sum[base + i] = value
+            return
+
+        self.count[row] += 1
+        for i, value in enumerate(values):
+            if value < self.min[base + i]:
+                self.min[base + i] = value
+            if value > self.max[base + i]:
+                self.max[base + i] = value
+            self.sum[base + i] += value
+
+    def query(self, start, end):
+        """
+        Consolidate the steps between start and end into one (min, max, avg)
+        tuple per metric, None if there are no samples.
+        """
+        mins = [None] * self.metrics
+        maxs = [None] * self.metrics
+        sums = [0.0] * self.metrics
+        count = 0
+        first = int(start // self.step)
+        last = int(end // self.step)
+        for slot in range(max(first, last - self.rows + 1), last + 1):
+            row = slot % self.rows
+            if self.slots[row] != slot:
+                continue
+            base = row * self.metrics
+            count += self.count[row]
+            for i in range(self.metrics):
+                if mins[i] is None or self.min[base + i] < mins[i]:
+                    mins[i] = self.min[base + i]
+                if maxs[i] is None or self.max[base + i] > maxs[i]:
+                    maxs[i] = self.max[base + i]
+                sums[i] += self.sum[base + i]
+
+        if not count:
+            return None
+        return [(mins[i], maxs[i], sums[i] / count) for i in range(self.metrics)]
+
+
+class TimeSeries(object):
+    """Every sample is added to each tier, queries read a single tier."""
+
+    def __init__(self, tiers):
+        self.archives = [Archive(step, rows) for step, rows in tiers]
+
+    def add(self, timestamp, values):
+        for archive in self.archives:
+            archive.add(timestamp, values)
+
+    def tier(self, window):
+        """The archive answering queries of the last window seconds."""
+        for archive in self.archives:
+            if window <= archive.span and window / archive.step <= TREND_MAX_ROWS:
+                return archive
+        return self.archives[-1]
+
+    def query(self, window, now=None):
+        if now is None:
+            now = clock()
+        return self.tier(window).query(now - window, now)
+
+
+STATUS_FIELDS = ('nodes', 'gateways', 'clients')
+STATUS_LABELS = {'nodes': 'Nodes', 'gateways': 'Gateways', 'clients': 'Clients'}
+
+
+class WindowExtreme(object):
+    """
+    Maximum (or minimum) of the samples of the last window seconds. The
+    deque only keeps samples that can still become the extreme, so adding
+    a sample costs O(1) amortised.
+    """
+
+    def __init__(self, window, maximum=True):
+        self.window = window
+        self.maximum = maximum
+        self.samples = deque()
+
+    def add(self, now, value):
+        samples = self.samples
+        if self.maximum:
+            while samples and samples[-1][1] <= value:
+                samples.pop()
+        else:
+            while samples and samples[-1][1] >= value:
+                samples.pop()
+        samples.append((now, value))
+        while samples[0][0] < now - self.window:
+            samples.popleft()
+        return samples[0][1]
+
+
+class ChangeRule(object):
+    """Fires when a value dropped (or rose) by percent within window."""
+
+    def __init__(self, text, field, direction, percent, window):
+        self.text = text
+        self.field = field
+        self.drop = direction == 'drop'
+        self.percent = percent
+        self.window = window
+        self.extreme = WindowExtreme(window, maximum=self.drop)
+
+    def check(self, now, value):
+        reference = self.extreme.add(now, value)
+        if not reference:
+            return None
+        change = 100.0 * (reference - value) / reference
+        if not self.drop:
+            change = -change
+        if change < self.percent:
+            return None
+        return '{} um {:.0f} % {} ({} → {} in {})'.format(
+            STATUS_LABELS[self.field], change, 'gefallen' if self.drop else 'gestiegen',
+            reference, value, format_duration(self.window))
+
+
+class ThresholdRule(object):
+    """Fires when a value stayed below (or above) a limit for some polls."""
+
+    def __init__(self, text, field, direction, limit, polls):
+        self.text = text
+        self.field = field
+        self.below = direction == 'below'
+        self.limit = limit
+        self.polls = polls
+        self.count = 0
+
+    def check(self, now, value):
+        if (value < self.limit) if self.below else (value > self.limit):
+            self.count += 1
+        else:
+            self.count = 0
+        if self.count < self.polls:
+            return None
+        return '{} seit {} Abfragen {} {} (derzeit {})'.format(
+            STATUS_LABELS[self.field], self.count, 'unter' if self.below else 'über',
+            self.limit, value)
+
+
+ALERT_RULES = (
+    (re.compile(r'^(nodes|gateways|clients)\s+(drop|rise)\s+(\d+(?:\.\d+)?)\s*%\s+in\s+(\w+)$'),
+     lambda text, m: ChangeRule(text, m.group(1), m.group(2), float(m.group(3)),
+                                parse_duration(m.group(4)))),
+    (re.compile(r'^(nodes|gateways|clients)\s+(below|above)\s+(\d+)\s+for\s+(\d+)\s+polls?$'),
+     lambda text, m: ThresholdRule(text, m.group(1), m.group(2), int(m.group(3)),
+                                   int(m.group(4)))),
+)
+
+
+def parse_alert_rule(text):
+    """Parse rules like "clients drop 30% in 5m" or "nodes below 500 for
+    3 polls"."""
+    text = ' '.join(text.lower().split())
+    for pattern, make in ALERT_RULES:
+        match = pattern.match(text)
+        if match:
+            return make(text, match)
+    raise ValueError('Invalid alert rule: {}'.format(text))
+
+
+class Alerts(object):
+    """
+    Evaluates the alert rules against every sample of the total status.
+    A rule alerts when it starts firing and not again until it stopped for
+    a sample and its cooldown passed. Alerts are sent at most once per
+    interval; those raised in between are collected and sent together,
+    leaving out the ones that stopped firing in the meantime.
+    """
+
+    def __init__(self, rules, interval):
+        self.rules = rules
+        self.interval = interval
+        self.firing = {}
+        self.last_alert = {}
+        self.pending = OrderedDict()
+        self.last_sent = None
+
+    def add(self, now, status):
+        """Evaluate a sample, returning the message to send if any."""
+        values = dict(zip(STATUS_FIELDS, status))
+        for rule in self.rules:
+            message = rule.check(now, values[rule.field])
+            if message is None:
+                self.firing.pop(rule, None)
+                self.pending.pop(rule, None)
+                continue
+            cooled = now - self.last_alert.get(rule, now - self.interval) >= self.interval
+            if (rule not in self.firing and cooled) or rule in self.pending:
+                self.pending[rule] = message
+            self.firing[rule] = message
+
+        if not self.pending:
+            return None
+        if self.last_sent is not None and now - self.last_sent < self.interval:
+            return None
+        messages = list(self.pending.values())
+        for rule in self.pending:
+            self.last_alert[rule] = now
+        self.pending.clear()
+        self.last_sent = now
+        return 'Achtung: {}.'.format('; '.join(messages))
+
+
+def load_alerts(bot):
+    rules = []
+    for text in (bot.config.freifunk.alert_rules or '').split(';'):
+        if not text.strip():
+            continue
+        try:
+            rules.append(parse_alert_rule(text))
+        except ValueError as e:
+            print('Warning: {}'.format(e))
+    return Alerts(rules, parse_duration(bot.config.freifunk.alert_interval or '10m'))
+
+
+def check_alerts(bot):
+    """Feed the total status to the alert rules once every domain reported."""
+    ffda = bot.memory['ffda']
+    if 'status' not in ffda or not domains_reported(ffda['domains'].values()):
+        return
+    msg = ffda['alerts'].add(clock(), ffda['status'])
+    if msg:
+        announce(bot, msg)
+
+
+def format_duration(seconds):
+    for unit, size in (('d', 86400), ('h', 3600), ('min', 60)):
+        if seconds >= size and seconds % size == 0:
+            return '{} {}'.format(seconds // size, unit)
+    return '{} s'.format(seconds)
+
+
+def parse_duration(value):
+    """Parse durations like 90s, 15m, 1h, 7d, 2w or 1y into seconds."""
+    match = re.match(r'^(\d+)\s*([smhdwy])$', value.strip().lower())
+    if not match:
+        raise ValueError('Invalid duration: {}'.format(value))
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'y': 365 * 86400}
+    return int(match.group(1)) * units[match.group(2)]
 
+
+def config_bool(value, default=False):
+    if value is None:
+        return default
+    return value.strip().lower() not in ('false', 'no', 'off', '0')
+
+
+def update_highscore(bot, hs, nodes, clients, public=False):
     # total highscore
     new_highscore = False
     if nodes > hs['nodes']:
         hs['nodes'] = nodes
-        hs['nodes_dt'] = time.time()
+        hs['nodes_dt'] = clock()
         new_highscore = True
     if nodes > hs['daily_nodes']:
         hs['daily_nodes'] = nodes
-        hs['daily_nodes_dt'] = time.time()
+        hs['daily_nodes_dt'] = clock()
 
     if clients > hs['clients']:
         hs['clients'] = clients
-        hs['clients_dt'] = time.time()
+        hs['clients_dt'] = clock()
         new_highscore = True
     if clients > hs['daily_clients']:
         hs['daily_clients'] = clients
-        hs['daily_clients_dt'] = time.time()
+        hs['daily_clients_dt'] = clock()
 
-    if new_highscore:
+    if new_highscore and public:
         msg = "Neuer Highscore von {} Nodes ({}) und {} Clients ({}).".format(
                   hs['nodes'], pretty_date(hs['nodes_dt']),
                   hs['clients'], pretty_date(hs['clients_dt']))
-        print(msg)
-        bot.msg(bot.config.freifunk.announce_target, msg)
+        announce(bot, msg)
+
+
+def check_daychange(bot):
+    hs = bot.memory['ffda']['highscore']
 
-    # detect daychange
     if day_changed(hs['daily_dt']):
         tpl = "Der gestrige Highscore liegt bei {} Nodes ({}) und {} Clients ({})."
         msg = tpl.format(hs['daily_nodes'], pretty_date(hs['daily_nodes_dt']),
                          hs['daily_clients'], pretty_date(hs['daily_clients_dt']))
-        print(msg)
-        bot.msg(bot.config.freifunk.announce_target, msg)
+        announce(bot, msg)
+
+    ffda = bot.memory['ffda']
+    current = [(ffda['highscore'], ffda.get('status'))]
+    current.extend((domain.highscore, domain.status) for domain in ffda['domains'].values()
+                   if domain.highscore is not None)
+    for hs, status in current:
+        if day_changed(hs['daily_dt']):
+            hs.record_day()
+            reset_highscore(hs, status)
 
-        reset_highscore(hs)
 
-    bot.memory['ffda']['highscore'] = hs
+def find_domain(bot, name):
+    """Return the named domain, or tell the user which ones exist."""
+    domains = bot.memory['ffda']['domains']
+    if name in domains:
+        return domains[name]
+    bot.say('Unbekannte Domain {}. Bekannt sind: {}.'.format(name, ', '.join(domains)))
+    return None
 
 
 @willie.module.commands('status')
@@ -136,6 +2634,13 @@ def status(bot, trigger):
     hs = bot.memory['ffda']['highscore']
     status = bot.memory['ffda'].get('status', None)
 
+    if trigger.group(2):
+        domain = find_domain(bot, trigger.group(2).strip())
+        if domain is None:
+            return
+        status = domain.status
+        hs = domain.highscore or hs
+
     if status is None:
         bot.say('Noch keine Daten.')
         return
@@ -155,6 +2660,11 @@ def highscore(bot, trigger):
         return
 
     hs = bot.memory['ffda']['highscore']
+    if trigger.group(2):
+        domain = find_domain(bot, trigger.group(2).strip())
+        if domain is None:
+            return
+        hs = domain.highscore or hs
 
     tpl = "Der Highscore liegt bei {} Nodes ({}) und {} Clients ({})."
     msg = tpl.format(hs['nodes'], pretty_date(hs['nodes_dt']),
@@ -163,6 +2673,347 @@ def highscore(bot, trigger):
     print(msg)
 
 
+@willie.module.commands('trend')
+def trend(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    window = trigger.group(2) or '1h'
+    try:
+        seconds = parse_duration(window)
+    except ValueError:
+        bot.say('Bitte einen Zeitraum wie 1h, 1d oder 7d angeben.')
+        return
+
+    result = bot.memory['ffda']['history'].query(seconds)
+    if result is None:
+        bot.say('Noch keine Daten.')
+        return
+
+    tpl = "{}: {}–{} (Ø {:.0f})"
+    parts = [tpl.format(name, *values)
+             for name, values in zip(('Nodes', 'Gateways', 'Clients'), result)]
+    msg = "Letzte {}: {}.".format(window, ', '.join(parts))
+    bot.say(msg)
+    print(msg)
+
+
+# nodes listed by .node when a query matches several
+NODE_MATCHES = 10
+
+
+@willie.module.commands('node')
+def node(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    query = trigger.group(2)
+    if not query:
+        bot.say('Bitte einen Hostnamen, eine MAC oder eine Node-ID angeben.')
+        return
+
+    domains = bot.memory['ffda']['domains'].values()
+    for domain in domains:
+        index = domain.nodes
+        slot = index.find(query)
+        if slot is not None:
+            break
+    else:
+        matches = []
+        more = False
+        for domain in domains:
+            found, truncated = domain.nodes.lookup(query, NODE_MATCHES - len(matches))
+            matches.extend((domain.nodes, slot) for slot in found)
+            more = more or truncated
+        if not matches:
+            bot.say('Node {} ist unbekannt.'.format(query))
+            return
+        if len(matches) > 1:
+            names = ', '.join(index.name(slot) for index, slot in matches)
+            bot.say('Passende Nodes: {}{}.'.format(names, ' und weitere' if more else ''))
+            return
+        index, slot = matches[0]
+
+    if index.online[slot]:
+        state = 'online, {} Clients'.format(index.clients[slot])
+        if index.gateways[slot]:
+            state += ' über {}'.format(index.gateways[slot])
+    elif index.last_seen[slot]:
+        state = 'offline, zuletzt gesehen {}'.format(pretty_date(index.last_seen[slot]))
+    else:
+        state = 'offline'
+    if slot in index.flapping:
+        state += ', instabil'
+    first_seen = bot.memory['ffda']['registry'].first_seen.get(index.ids[slot])
+    if first_seen:
+        state += ', erstmals gesehen {}'.format(pretty_date(first_seen))
+
+    bot.say('{} ({}): {}.'.format(index.name(slot), index.ids[slot], state))
+
+
+@willie.module.commands('uptime')
+def uptime(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    args = (trigger.group(2) or '').split()
+    window = 7 * 86400
+    if len(args) > 1:
+        try:
+            window = parse_duration(args[-1])
+            args = args[:-1]
+        except ValueError:
+            pass
+    if len(args) != 1:
+        bot.say('Aufruf: .uptime <Node> [Zeitraum, z.B. 1d, 7d oder 1y]')
+        return
+
+    for domain in bot.memory['ffda']['domains'].values():
+        slot = domain.nodes.find(args[0])
+        if slot is not None:
+            break
+    else:
+        bot.say('Node {} ist unbekannt.'.format(args[0]))
+        return
+
+    index = domain.nodes
+    result = domain.uptime.availability(index.ids[slot], clock(), window)
+    if result is None:
+        bot.say('Für {} gibt es noch keine Daten.'.format(index.name(slot)))
+        return
+    share, observed = result
+    if observed < 3600:
+        observed = '{:.0f} min'.format(observed / 60.0)
+    elif observed < 2 * 86400:
+        observed = '{:.0f} h'.format(observed / 3600.0)
+    else:
+        observed = '{:.0f} d'.format(observed / 86400.0)
+    msg = '{} war {} der Zeit online (beobachtet: {} der letzten {}), derzeit {}.'.format(
+        index.name(slot), format_percent(share), observed, format_duration(window),
+        'online' if index.online[slot] else 'offline')
+    bot.say(msg)
+    print(msg)
+
+
+# nodes listed by .near
+NEAR_MATCHES = 5
+NEAR_MAX_RADIUS = 50000
+
+
+def parse_distance(value):
+    """Parse distances like 300, 300m or 1.5km into metres."""
+    match = re.match(r'^(\d+(?:[.,]\d+)?)\s*(m|km)?$', value.strip().lower())
+    if not match:
+        raise ValueError('Invalid distance: {}'.format(value))
+    metres = float(match.group(1).replace(',', '.'))
+    return metres * 1000 if match.group(2) == 'km' else metres
+
+
+def format_distance(metres):
+    if metres < 1000:
+        return '{:.0f} m'.format(metres)
+    return '{:.1f}'.format(metres / 1000).rstrip('0').rstrip('.').replace('.', ',') + ' km'
+
+
+@willie.module.commands('near')
+def near(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    args = (trigger.group(2) or '').split()
+    if args and ',' in args[0].rstrip(','):
+        args[0:1] = args[0].split(',', 1)
+    args = [arg.rstrip(',') for arg in args]
+    try:
+        latitude, longitude = float(args[0]), float(args[1])
+        grid_cell(latitude, longitude)
+        radius = parse_distance(args[2]) if len(args) > 2 else None
+    except (IndexError, ValueError):
+        bot.say('Aufruf: .near <Breitengrad> <Längengrad> [Radius, z.B. 500m oder 2km]')
+        return
+    if radius is not None and radius > NEAR_MAX_RADIUS:
+        bot.say('Der Radius darf höchstens {} sein.'.format(format_distance(NEAR_MAX_RADIUS)))
+        return
+
+    hits = []
+    for domain in bot.memory['ffda']['domains'].values():
+        index = domain.nodes
+        if radius is None:
+            found = index.nearest(latitude, longitude, NEAR_MATCHES, NEAR_MAX_RADIUS)
+        else:
+            found = index.near(latitude, longitude, radius)
+        hits.extend((metres, index, slot) for metres, slot in found)
+    hits.sort(key=lambda hit: hit[0])
+
+    if not hits:
+        bot.say('Keine Nodes im Umkreis von {}.'.format(
+            format_distance(radius or NEAR_MAX_RADIUS)))
+        return
+
+    parts = []
+    for metres, index, slot in hits[:NEAR_MATCHES]:
+        if index.online[slot]:
+            state = 'online, {} Clients'.format(index.clients[slot])
+        else:
+            state = 'offline'
+        parts.append('{} ({}, {})'.format(index.name(slot), format_distance(metres), state))
+    if radius is None:
+        msg = 'Nächste Nodes: {}.'.format(', '.join(parts))
+    else:
+        online = sum(1 for _, index, slot in hits if index.online[slot])
+        clients = sum(index.clients[slot] for _, index, slot in hits)
+        msg = '{} Nodes ({} online, {} Clients) im Umkreis von {}: {}{}.'.format(
+            len(hits), online, clients, format_distance(radius), ', '.join(parts),
+            ' und weitere' if len(hits) > NEAR_MATCHES else '')
+    bot.say(msg)
+
+
+# values listed by .firmware, .models and .branches
+DISTRIBUTION_TOP = 5
+
+
+def say_distribution(bot, trigger, name, title):
+    """Answer with the most common values of a distribution, of one domain
+    if the command names one."""
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    distribution = bot.memory['ffda'].get('distribution')
+    if trigger.group(2):
+        domain = find_domain(bot, trigger.group(2).strip())
+        if domain is None:
+            return
+        distribution = domain.distribution
+
+    ranked = (distribution or {}).get(name)
+    if not ranked:
+        bot.say('Noch keine Daten.')
+        return
+
+    total = sum(nodes for _, nodes in ranked)
+    labels = {None: 'unbekannt', False: 'deaktiviert'}
+    parts = ['{} {:.0f} % ({})'.format(labels.get(value, value), 100.0 * nodes / total, nodes)
+             for value, nodes in ranked[:DISTRIBUTION_TOP]]
+    others = sum(nodes for _, nodes in ranked[DISTRIBUTION_TOP:])
+    if others:
+        parts.append('sonstige {:.0f} % ({})'.format(100.0 * others / total, others))
+    msg = '{} der {} Nodes online: {}.'.format(title, total, ', '.join(parts))
+    bot.say(msg)
+    print(msg)
+
+
+@willie.module.commands('firmware')
+def firmware(bot, trigger):
+    say_distribution(bot, trigger, 'firmware', 'Firmware')
+
+
+@willie.module.commands('models')
+def models(bot, trigger):
+    say_distribution(bot, trigger, 'model', 'Hardware')
+
+
+@willie.module.commands('branches')
+def branches(bot, trigger):
+    say_distribution(bot, trigger, 'branch', 'Autoupdater')
+
+
+@willie.module.commands('mesh')
+def mesh(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    domains = [domain for domain in bot.memory['ffda']['domains'].values() if domain.graph_uri]
+    if trigger.group(2):
+        domain = find_domain(bot, trigger.group(2).strip())
+        if domain is None:
+            return
+        domains = [domain]
+    if not domains:
+        bot.say('Es ist kein Link-Graph konfiguriert.')
+        return
+
+    parts = []
+    for domain in domains:
+        partition = domain.mesh
+        if partition is None:
+            text = 'noch keine Daten'
+        elif not partition.islands:
+            text = 'alle {} Knoten haben einen Uplink'.format(partition.nodes)
+        else:
+            isolated = sum(len(island) for island in partition.islands)
+            text = '{} Knoten ohne Uplink in {} {} (größte: {})'.format(
+                isolated, len(partition.islands),
+                'Insel' if len(partition.islands) == 1 else 'Inseln',
+                format_graph_nodes(domain, partition.islands[0], limit=5))
+        parts.append('{}: {}'.format(domain.name, text) if len(domains) > 1 else text)
+    msg = 'Mesh: {}.'.format('; '.join(parts))
+    bot.say(msg)
+    print(msg)
+
+
+# gateways listed by .gateways
+GATEWAY_TOP = 8
+
+
+@willie.module.commands('gateways')
+def gateways(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    domains = list(bot.memory['ffda']['domains'].values())
+    if trigger.group(2):
+        domain = find_domain(bot, trigger.group(2).strip())
+        if domain is None:
+            return
+        domains = [domain]
+    loads = domains[0].gateways if len(domains) == 1 else merge_loads(domains)
+
+    if not loads:
+        bot.say('Noch keine Daten.')
+        return
+
+    ranked = sorted(loads.items(), key=lambda item: (-item[1][0], item[0]))
+    parts = ['{} ({} Nodes, {} Clients)'.format(gateway, nodes, clients)
+             for gateway, (nodes, clients) in ranked[:GATEWAY_TOP]]
+    if len(ranked) > GATEWAY_TOP:
+        parts.append('{} weitere'.format(len(ranked) - GATEWAY_TOP))
+    msg = '{} Gateways: {}. Ungleichgewicht: {} (max/Ø Nodes).'.format(
+        len(ranked), ', '.join(parts), '{:.2f}'.format(gateway_imbalance(loads)).replace('.', ','))
+    bot.say(msg)
+    print(msg)
+
+
+@willie.module.commands('pollstats')
+def pollstats(bot, trigger):
+    # restrict to announce channel
+    if not trigger.args[0] == bot.config.freifunk.announce_target:
+        return
+
+    domains = bot.memory['ffda']['domains'].values()
+    stats = dict((key, sum(domain.stats[key] for domain in domains)) for key in FETCH_STATS)
+    average = stats['bytes'] / stats['full'] if stats['full'] else 0
+
+    tpl = ("Abrufe seit Start: {} vollständig ({:.1f} MB), {} nicht geändert, {} unverändert, "
+           "{} fehlgeschlagen. Gespart: ca. {:.1f} MB und {} Auswertungen.")
+    msg = tpl.format(stats['full'], stats['bytes'] / 2.0 ** 20,
+                     stats['not_modified'], stats['unchanged'], stats['failed'],
+                     average * stats['not_modified'] / 2.0 ** 20,
+                     stats['not_modified'] + stats['unchanged'])
+    formats = ['{}: {}'.format(domain.name, domain.fetch['format'])
+               for domain in domains if 'format' in domain.fetch]
+    if formats:
+        msg += ' Format: {}.'.format(', '.join(formats))
+    bot.say(msg)
+    print(msg)
+
+
 @willie.module.commands('agenda')
 def agenda(bot, trigger):
     # restrict to announce channel
@@ -187,7 +3038,7 @@ def ffda_help(bot, trigger):
         return
 
     prefix = bot.config.core.prefix
-    commands = ( '{prefix}{cmd}'.format(prefix=prefix, cmd=cmd) for cmd in ('agenda', 'highscore', 'status'))
+    commands = ( '{prefix}{cmd}'.format(prefix=prefix, cmd=cmd) for cmd in ('agenda', 'branches', 'firmware', 'gateways', 'highscore', 'mesh', 'models', 'near', 'node', 'pollstats', 'status', 'trend', 'uptime'))
 
     msg = "Befehle: {cmds}".format(cmds=', '.join(commands))
 
@@ -237,7 +3088,7 @@ def pretty_date(timestamp=None):
     pretty string like 'an hour ago', 'Yesterday', '3 months ago',
     'just now', etc
     """
-    now = datetime.now()
+    now = datetime.fromtimestamp(clock())
     compare = None
     if isinstance(timestamp, int):
         compare = datetime.fromtimestamp(timestamp)
@@ -278,7 +3129,7 @@ def pretty_date(timestamp=None):
 
 def day_changed(since):
     then = datetime.fromtimestamp(since).strftime('%x')
-    return then != time.strftime('%x')
+    return then != datetime.fromtimestamp(clock()).strftime('%x')
 
 def get_next_plenum(now=None):
     if now is None:
@@ -0,0 +1,52 @@
+# coding=utf8
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'willie'))
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+
+import willie.bot  # noqa: E402,F401  (the bot is loaded before its modules)
+from willie.config import Config  # noqa: E402
+from willie.db import WillieDB  # noqa: E402
+import ffda_netstate  # noqa: E402
+
+
+class MockBot(object):
+    """Just enough of a Willie instance for the netstate module."""
+
+    def __init__(self, config):
+        self.config = config
+        self.db = WillieDB(config)
+        self.memory = {}
+        self.messages = []
+
+    def msg(self, recipient, text, max_messages=1):
+        self.messages.append(text)
+
+
+@pytest.fixture
+def make_bot(tmpdir):
+    """Return a function that sets up the module with [freifunk] options."""
+    bots = []
+
+    def make(**options):
+        filename = os.path.join(str(tmpdir), 'bot.cfg')
+        with io.open(filename, 'w', encoding='utf-8') as cfg:
+            cfg.write(u'[core]\nnick=bot\nowner=owner\nhost=localhost\n'
+                      u'db_filename={}\n\n[freifunk]\nannounce_target=#test\n'
+                      u'ffmap_nodes_uri=http://localhost/nodes.json\n'.format(
+                          os.path.join(str(tmpdir), 'bot.db')))
+            for key, value in options.items():
+                cfg.write(u'{}={}\n'.format(key, value))
+        bot = MockBot(Config(filename))
+        ffda_netstate.setup(bot)
+        bots.append(bot)
+        return bot
+
+    yield make
+    for bot in bots:
+        ffda_netstate.shutdown(bot)
@@ -0,0 +1,543 @@
+# coding=utf8
+"""Tests for modules/ffda_netstate.py"""
+from __future__ import unicode_literals
+
+import json
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import ffda_netstate
+
+
+def make_node(node_id, online=True, clients=1, gateway='gw1', hostname=None):
+    return {
+        'flags': {'online': online, 'gateway': False},
+        'nodeinfo': {'node_id': node_id, 'hostname': hostname or 'node-' + node_id},
+        'statistics': {'clients': clients, 'gateway': gateway},
+    }
+
+
+def located_nodes(count):
+    nodes = []
+    for i in range(count):
+        node = make_node('n%d' % i, online=i % 3 != 0, clients=i * 7 % 23)
+        node['nodeinfo']['location'] = {'latitude': 49.87 + i * 1e-05,
+                                        'longitude': -8.6512 - i * 0.25e-3}
+        nodes.append(node)
+    return nodes
+
+
+def payload(nodes):
+    return json.dumps({'version': 2, 'timestamp': '2015-06-01T12:00:00',
+                       'nodes': nodes}).encode('utf-8')
+
+
+def chunks(data, size):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [3, 4, 11, 12])
+def test_json_stream_numbers(size):
+    data = b'{"version": 2, "x": 1.5e3, "nodes": []}'
+    stream = ffda_netstate.JSONStream(chunks(data, size))
+    assert list(stream.items()) == [2, 1500.0, []]
+    assert list(ffda_netstate.iter_map(chunks(data, size), {})) == []
+
+
+def test_iter_map_random_chunks():
+    # numbers outside of the nodes are decoded on their own
+    data = json.dumps({'version': 2, 'scale': 1.25e-07, 'x': 1500.0, 'y': -12,
+                       'nodes': located_nodes(50)}).encode('utf-8')
+    expected = list(ffda_netstate.iter_document(json.loads(data.decode('utf-8')), {}))
+    rng = random.Random(1)
+    for _ in range(50):
+        parts = []
+        offset = 0
+        while offset < len(data):
+            size = rng.randint(1, 16)
+            parts.append(data[offset:offset + size])
+            offset += size
+        assert list(ffda_netstate.iter_map(parts, {})) == expected
+
+
+def poll_index(index, states, finish=True):
+    """Pass {node_id: online} to the index like one poll."""
+    index.begin(0, 1800, 4)
+    for node_id, online in states:
+        index.update(node_id, node_id, online, 0, None)
+    if finish:
+        index.finish()
+
+
+def names(index, slots):
+    return sorted(index.ids[slot] for slot in slots)
+
+
+def test_changes_kept_until_cleared():
+    index = ffda_netstate.NodeIndex()
+    poll_index(index, [('a', True), ('b', True), ('c', True)])
+    index.clear_changes()
+    # a poll that fails after the first node
+    poll_index(index, [('a', False)], finish=False)
+    poll_index(index, [('a', False), ('b', True), ('c', False)])
+    assert names(index, index.went_offline) == ['a', 'c']
+    index.clear_changes()
+    assert index.went_offline == [] and index.went_online == []
+
+
+def test_change_reverted_before_announcement():
+    index = ffda_netstate.NodeIndex()
+    poll_index(index, [('a', True), ('b', True)])
+    index.clear_changes()
+    poll_index(index, [('a', False)], finish=False)
+    poll_index(index, [('a', True), ('b', True)])
+    assert index.went_offline == [] and index.went_online == []
+
+
+def test_truncated_poll_announced_later(make_bot):
+    bot = make_bot(announce_nodes='True')
+    domain = bot.memory['ffda']['domains']['ffda']
+    nodes = [make_node('n%d' % i) for i in range(5)]
+    ffda_netstate.apply_map_data(bot, domain, chunks(payload(nodes), 100))
+
+    nodes[0]['flags']['online'] = False
+    data = payload(nodes)
+    with pytest.raises(ValueError):
+        ffda_netstate.apply_map_data(bot, domain, chunks(data, 100)[:3])
+    ffda_netstate.apply_map_data(bot, domain, chunks(data, 100))
+    assert bot.messages[-1] == 'Offline: node-n0.'
+
+
+def test_new_nodes_kept_until_announced(make_bot):
+    bot = make_bot()
+    domain = bot.memory['ffda']['domains']['ffda']
+    nodes = [make_node('n%d' % i) for i in range(5)]
+    ffda_netstate.apply_map_data(bot, domain, chunks(payload(nodes), 100))
+
+    data = payload(nodes + [make_node('new', hostname='fresh')])
+    with pytest.raises(ValueError):
+        ffda_netstate.apply_map_data(bot, domain, chunks(data, 100)[:-1])
+    ffda_netstate.apply_map_data(bot, domain, chunks(data, 100))
+    assert bot.messages[-1] == 'Neuer Node: fresh.'
+    assert domain.nodes.appeared == []
+
+
+def test_registry_seeded_from_restored_state(make_bot, tmpdir):
+    bot = make_bot()
+    domain = bot.memory['ffda']['domains']['ffda']
+    nodes = [make_node('n%d' % i) for i in range(5)]
+    ffda_netstate.apply_map_data(bot, domain, chunks(payload(nodes), 100))
+    ffda_netstate.save_state(bot, domain)
+    # a state file from before the registry was kept
+    tmpdir.join('ffda-nodes.txt').remove()
+
+    bot = make_bot()
+    registry = bot.memory['ffda']['registry']
+    assert len(registry) == 5
+    domain = bot.memory['ffda']['domains']['ffda']
+    data = payload(nodes + [make_node('new', hostname='fresh')])
+    ffda_netstate.apply_map_data(bot, domain, chunks(data, 100))
+    assert bot.messages[-1] == 'Neuer Node: fresh.'
+
+
+def test_total_counts_shared_gateways_once(make_bot):
+    bot = make_bot(ffmap_domains='north=http://localhost/n.json,south=http://localhost/s.json')
+    domains = bot.memory['ffda']['domains']
+    ffda_netstate.apply_map_data(bot, domains['north'], [payload(
+        [make_node('n1', gateway='gw1'), make_node('n2', gateway='gw2')])])
+    ffda_netstate.apply_map_data(bot, domains['south'], [payload(
+        [make_node('s1', gateway='gw2'), make_node('s2', gateway='gw3')])])
+    ffda_netstate.update_total(bot)
+    assert domains['north'].status == (2, 2, 2)
+    assert bot.memory['ffda']['status'] == (4, 3, 4)
+
+
+def local_time(*args):
+    return time.mktime(datetime(*args).timetuple())
+
+
+def uptime_day(pattern, day=(2015, 6, 1), polls=384):
+    """Record a day of polls, four per slot, with the nodes online at a
+    poll given by pattern(node_id, poll), and start the next day."""
+    index = ffda_netstate.NodeIndex()
+    poll_index(index, [('steady', True), ('flapping', True)])
+    uptime = ffda_netstate.Uptime()
+    start = local_time(*day)
+    for poll in range(polls):
+        for slot, node_id in enumerate(index.ids):
+            index.online[slot] = 1 if pattern(node_id, poll) else 0
+        uptime.add(start + poll * 225, index)
+    uptime.add(start + 86400, index)
+    return uptime, start + 86400
+
+
+def online_slots(uptime, node_id):
+    return ffda_netstate.popcount(ffda_netstate.bits_int(
+        uptime.history[uptime.slots[node_id]]))
+
+
+def test_uptime_rotate():
+    uptime, _ = uptime_day(lambda node_id, poll: node_id == 'steady' or poll % 2)
+    assert uptime.days == [date(2015, 6, 1).toordinal()]
+    assert uptime.observed == [(1 << ffda_netstate.UPTIME_SLOTS) - 1]
+    assert online_slots(uptime, 'steady') == 96
+    # online in half of the polls of every slot: half of the slots, not all
+    assert online_slots(uptime, 'flapping') == 48
+    assert dict((uptime.ids[slot], share) for share, slot in uptime.report) == {
+        'steady': 1.0, 'flapping': 0.5}
+
+
+def test_uptime_rotate_short_outages():
+    # offline at one poll of every slot
+    uptime, _ = uptime_day(lambda node_id, poll: node_id == 'steady' or poll % 4)
+    assert online_slots(uptime, 'flapping') == 72
+
+
+@pytest.fixture
+def berlin():
+    if not hasattr(time, 'tzset'):
+        pytest.skip('needs time.tzset()')
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/Berlin'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+# the hour repeated in autumn shares its slots, the one skipped in spring
+# is not observed
+@pytest.mark.parametrize('day, slots', [((2026, 10, 25), 96), ((2026, 3, 29), 92)])
+def test_uptime_rotate_dst_change(berlin, day, slots):
+    index = ffda_netstate.NodeIndex()
+    poll_index(index, [('steady', True)])
+    uptime = ffda_netstate.Uptime()
+    start = local_time(*day)
+    end = local_time(*(date(*day) + timedelta(days=1)).timetuple()[:3])
+    assert end - start != 86400
+    for now in range(int(start), int(end), 225):
+        uptime.add(now, index)
+    uptime.add(end, index)
+    uptime.add(end + 225, index)
+    assert uptime.days == [date(*day).toordinal()]
+    assert ffda_netstate.popcount(uptime.observed[0]) == slots
+    assert online_slots(uptime, 'steady') == slots
+    share, observed = uptime.availability('steady', end + 300, 2 * 86400)
+    assert share == 1.0
+
+
+def test_uptime_availability():
+    uptime, now = uptime_day(lambda node_id, poll: node_id == 'steady' or poll % 2,
+                             polls=192)
+    assert uptime.availability('unknown', now, 86400) is None
+    # the first half of the day was observed, and the poll at midnight
+    share, observed = uptime.availability('steady', now + 1, 2 * 86400)
+    assert share == 1.0
+    assert observed == 48 * ffda_netstate.UPTIME_SLOT + ffda_netstate.POLL_INTERVAL
+    share, observed = uptime.availability('flapping', now + 1, 2 * 86400)
+    assert abs(share - 0.5) < 0.01
+    # only today's poll
+    share, observed = uptime.availability('flapping', now + 1, 60)
+    assert observed == ffda_netstate.POLL_INTERVAL
+
+
+def test_metrics_rendered_again_after_new_data(make_bot):
+    bot = make_bot()
+    domain = bot.memory['ffda']['domains']['ffda']
+    ffda_netstate.apply_map_data(bot, domain, [payload([make_node('n1')])])
+    domain.updates += 1
+    ffda_netstate.render_metrics(bot)
+    assert b'ffda_domain_nodes{domain="ffda"} 1\n' in bot.memory['ffda']['metrics']
+
+    # a poll answered with 304 only changes the counters
+    domain.stats['not_modified'] += 1
+    domain.status = (2, 1, 2)
+    ffda_netstate.render_metrics(bot)
+    metrics = bot.memory['ffda']['metrics']
+    assert b'ffda_fetches_total{domain="ffda",result="not_modified"} 1\n' in metrics
+    assert b'ffda_domain_nodes{domain="ffda"} 1\n' in metrics
+
+    domain.updates += 1
+    ffda_netstate.render_metrics(bot)
+    assert b'ffda_domain_nodes{domain="ffda"} 2\n' in bot.memory['ffda']['metrics']
+
+
+class MockResponse(object):
+    def __init__(self, body):
+        self.body = body
+        self.status_code = 200
+        self.headers = {'ETag': '"1"'}
+        self.raw = self
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        return chunks(self.body, size)
+
+    def tell(self):
+        return len(self.body)
+
+    def close(self):
+        pass
+
+
+def test_invalid_map_data_counts_as_failed(make_bot, monkeypatch):
+    bodies = {'http://localhost/n.json': payload([make_node('n1'), make_node('n2')]),
+              'http://localhost/s.json': b'{"nodes": [}'}
+    monkeypatch.setattr(ffda_netstate.SESSION, 'get',
+                        lambda uri, **kwargs: MockResponse(bodies[uri]))
+    bot = make_bot(ffmap_domains='north=http://localhost/n.json,south=http://localhost/s.json')
+    domains = bot.memory['ffda']['domains']
+    ffda_netstate.poll_domains(bot)
+    assert domains['south'].stats['failed'] == 1
+    assert domains['south'].fetch['retry_at'] > time.time()
+    # the total is complete without the failing domain
+    assert ffda_netstate.domains_reported(domains.values())
+    assert bot.memory['ffda']['highscore']['nodes'] == 2
+
+
+def test_daily_highscore_starts_from_current_status(make_bot):
+    bot = make_bot(ffmap_domains='north=http://localhost/n.json,south=http://localhost/s.json')
+    domains = bot.memory['ffda']['domains']
+    ffda_netstate.apply_map_data(bot, domains['north'], [payload(
+        [make_node('n1', clients=3), make_node('n2', clients=4)])])
+    ffda_netstate.apply_map_data(bot, domains['south'], [payload([make_node('s1')])])
+    ffda_netstate.update_total(bot)
+
+    # the first poll after midnight is answered with 304
+    highscores = list(ffda_netstate.highscores(bot))
+    for hs in highscores:
+        hs['daily_dt'] -= 86400
+    ffda_netstate.check_daychange(bot)
+    ffda_netstate.update_total(bot)
+    total, north, south = highscores
+    assert (total['daily_nodes'], total['daily_clients']) == (3, 8)
+    assert (north['daily_nodes'], north['daily_clients']) == (2, 7)
+    assert (south['daily_nodes'], south['daily_clients']) == (1, 1)
+
+
+def test_announce_names_domain(make_bot):
+    bot = make_bot()
+    domain = bot.memory['ffda']['domains']['ffda']
+    ffda_netstate.announce(bot, 'Hallo.', domain)
+    bot = make_bot(ffmap_domains='north=http://localhost/n.json,south=http://localhost/s.json')
+    ffda_netstate.announce(bot, 'Hallo.', bot.memory['ffda']['domains']['south'])
+    ffda_netstate.announce(bot, 'Alle.')
+    assert bot.messages == ['[south] Hallo.', 'Alle.']
+
+
+def archive_entry(node_id, **fields):
+    entry = {'node_id': node_id, 'hostname': 'node-' + node_id, 'clients': 1}
+    entry.update(fields)
+    return entry
+
+
+def test_archive_round_trip(tmpdir):
+    directory = str(tmpdir)
+    archive = ffda_netstate.SnapshotArchive(directory, keyframe_interval=600)
+    start = local_time(2015, 6, 1, 23, 40)
+    a, b = archive_entry('a'), archive_entry('b', model='TL-WR841N')
+    snapshots = [
+        (start, {'a': a, 'b': b}),
+        # a changed, b lost a key, c is new
+        (start + 60, {'a': archive_entry('a', clients=5),
+                      'b': archive_entry('b'),
+                      'c': archive_entry('c')}),
+        # b vanished
+        (start + 120, {'a': archive_entry('a', clients=5), 'c': archive_entry('c')}),
+        # a keyframe after keyframe_interval
+        (start + 660, {'a': archive_entry('a', clients=2), 'c': archive_entry('c')}),
+        (start + 720, {'a': archive_entry('a', clients=3)}),
+        # the next day starts a new segment with a keyframe
+        (start + 1260, {'a': archive_entry('a', clients=4)}),
+        (start + 1320, {'a': archive_entry('a', clients=4), 'b': b}),
+    ]
+    for timestamp, entries in snapshots:
+        archive.write('ffda', timestamp, json.loads(json.dumps(entries)))
+
+    kinds = [kind for _, _, kind in ffda_netstate.read_archive_index(
+        ffda_netstate.archive_name(directory, 'ffda', start))]
+    keyframe, delta = ffda_netstate.KEYFRAME, ffda_netstate.DELTA
+    assert kinds == [keyframe, delta, delta, keyframe, delta]
+    kinds = [kind for _, _, kind in ffda_netstate.read_archive_index(
+        ffda_netstate.archive_name(directory, 'ffda', start + 1260))]
+    assert kinds == [keyframe, delta]
+
+    assert ffda_netstate.reconstruct_snapshot(directory, 'ffda', start - 1) is None
+    for timestamp, entries in snapshots:
+        assert ffda_netstate.reconstruct_snapshot(directory, 'ffda', timestamp) == (
+            timestamp, entries)
+        # between snapshots, the one before
+        assert ffda_netstate.reconstruct_snapshot(directory, 'ffda', timestamp + 30) == (
+            timestamp, entries)
+    # after midnight, before the first snapshot of the day
+    midnight = local_time(2015, 6, 2)
+    assert ffda_netstate.reconstruct_snapshot(directory, 'ffda', midnight + 30) == (
+        snapshots[4][0], snapshots[4][1])
+
+
+def test_window_extreme_expires():
+    maximum = ffda_netstate.WindowExtreme(60)
+    assert [maximum.add(now, value) for now, value in
+            ((0, 10), (30, 5), (60, 4), (61, 3), (91, 2))] == [10, 10, 10, 5, 4]
+    minimum = ffda_netstate.WindowExtreme(60, maximum=False)
+    assert [minimum.add(now, value) for now, value in
+            ((0, 1), (30, 5), (61, 7))] == [1, 1, 5]
+
+
+def test_change_rule():
+    rule = ffda_netstate.parse_alert_rule('Clients  drop 30% in 5m')
+    assert rule.check(0, 100) is None
+    assert rule.check(60, 80) is None
+    assert rule.check(120, 70) == 'Clients um 30 % gefallen (100 → 70 in 5 min)'
+    # the 100 left the window
+    assert rule.check(301, 65) is None
+    rise = ffda_netstate.parse_alert_rule('nodes rise 50% in 1h')
+    assert rise.check(0, 10) is None
+    assert rise.check(60, 16) == 'Nodes um 60 % gestiegen (10 → 16 in 1 h)'
+
+
+def test_threshold_rule():
+    rule = ffda_netstate.parse_alert_rule('gateways below 2 for 2 polls')
+    assert [rule.check(now, value) for now, value in enumerate((1, 2, 1, 1))] == [
+        None, None, None, 'Gateways seit 2 Abfragen unter 2 (derzeit 1)']
+    with pytest.raises(ValueError):
+        ffda_netstate.parse_alert_rule('gateways below two')
+
+
+def alerts(*rules):
+    return ffda_netstate.Alerts([ffda_netstate.parse_alert_rule(rule) for rule in rules], 600)
+
+
+def test_alerts_combined_after_interval():
+    alert = alerts('nodes below 10 for 1 poll', 'clients below 50 for 1 poll',
+                   'gateways below 2 for 1 poll')
+    assert alert.add(0, (5, 2, 100)) == 'Achtung: Nodes seit 1 Abfragen unter 10 (derzeit 5).'
+    # still firing, not repeated
+    assert alert.add(15, (5, 2, 100)) is None
+    # raised within the interval, collected
+    assert alert.add(60, (5, 2, 40)) is None
+    assert alert.add(120, (5, 1, 30)) is None
+    assert alert.add(600, (5, 1, 30)) == (
+        'Achtung: Clients seit 3 Abfragen unter 50 (derzeit 30); '
+        'Gateways seit 2 Abfragen unter 2 (derzeit 1).')
+
+
+def test_alerts_drop_cleared_rules():
+    alert = alerts('nodes below 10 for 1 poll', 'clients below 50 for 1 poll')
+    assert alert.add(0, (5, 2, 100)) is not None
+    assert alert.add(60, (20, 2, 40)) is None
+    # the clients recovered before the alert was due
+    assert alert.add(120, (20, 2, 100)) is None
+    assert alert.add(600, (20, 2, 100)) is None
+    assert not alert.pending
+
+
+def test_alerts_cooldown():
+    alert = alerts('nodes below 10 for 1 poll')
+    assert alert.add(0, (5, 2, 100)) is not None
+    assert alert.add(60, (20, 2, 100)) is None
+    # firing again within the cooldown of the last alert
+    assert alert.add(120, (5, 2, 100)) is None
+    assert alert.add(900, (5, 2, 100)) is None
+    # stopped and started again after the cooldown
+    assert alert.add(915, (20, 2, 100)) is None
+    assert alert.add(930, (5, 2, 100)) == 'Achtung: Nodes seit 1 Abfragen unter 10 (derzeit 5).'
+
+
+def saved_state(make_bot):
+    bot = make_bot()
+    domain = bot.memory['ffda']['domains']['ffda']
+    ffda_netstate.apply_map_data(bot, domain, [payload(located_nodes(30))])
+    ffda_netstate.save_state(bot, domain)
+    return bot, domain
+
+
+def test_state_round_trip(make_bot):
+    _, saved = saved_state(make_bot)
+    bot = make_bot(announce_nodes='True')
+    domain = bot.memory['ffda']['domains']['ffda']
+    assert domain.status == saved.status == (20, 1, sum(i * 7 % 23 for i in range(30)
+                                                        if i % 3 != 0))
+    assert domain.counts == saved.counts
+    assert domain.gateways == {'gw1': [20, saved.gateways['gw1'][1]]}
+    assert domain.fetch == dict((key, value) for key, value in saved.fetch.items()
+                                if key in ('etag', 'last_modified', 'digest', 'format'))
+
+    index, original = domain.nodes, saved.nodes
+    assert index.ids == original.ids and index.online == original.online
+    assert list(index.latitude) == list(original.latitude)
+    for query in ('node-n1', 'n2', 'NODE-N29'):
+        assert index.lookup(query) == original.lookup(query)
+    assert index.find('node-n7') == original.find('node-n7')
+    assert index.near(49.8701, -8.6517, 200) == original.near(49.8701, -8.6517, 200)
+    assert index.near(49.8701, -8.6517, 200)
+
+    # a poll goes on from the restored index
+    nodes = located_nodes(30)
+    nodes[1]['flags']['online'] = False
+    ffda_netstate.apply_map_data(bot, domain, [payload(nodes)])
+    assert 'Offline: node-n1.' in bot.messages
+
+
+def test_state_too_old(make_bot, monkeypatch):
+    saved_state(make_bot)
+    now = time.time() + ffda_netstate.STATE_MAX_AGE + 1
+    monkeypatch.setattr(ffda_netstate, 'clock', lambda: now)
+    domain = make_bot().memory['ffda']['domains']['ffda']
+    # the nodes are kept, but not the status, as it is out of date
+    assert len(domain.nodes) == 30
+    assert domain.status is None and domain.fetch == {}
+
+
+@pytest.mark.parametrize('damage', [
+    lambda data: data[:-10],
+    lambda data: data[:len(ffda_netstate.STATE_MAGIC) + 2],
+    lambda data: b'FFDAUP01' + data[8:],
+    lambda data: b'not a state file',
+])
+def test_state_rejected(make_bot, damage):
+    bot, domain = saved_state(make_bot)
+    path = ffda_netstate.state_path(bot, domain)
+    with open(path, 'rb') as state:
+        data = state.read()
+    with open(path, 'wb') as state:
+        state.write(damage(data))
+    fresh = ffda_netstate.Domain('ffda', domain.uri)
+    assert not ffda_netstate.load_state(bot, fresh)
+    assert len(fresh.nodes) == 0 and fresh.status is None
+
+
+@pytest.mark.parametrize('window, step', [
+    ('1h', 15), ('100m', 15), ('1d', 5 * 60), ('7d', 60 * 60), ('2w', 60 * 60),
+    ('1y', 86400), ('5y', 86400),
+])
+def test_trend_tier(window, step):
+    history = ffda_netstate.TimeSeries(ffda_netstate.HISTORY_TIERS)
+    archive = history.tier(ffda_netstate.parse_duration(window))
+    assert archive.step == step
+    if window != '5y':
+        rows = ffda_netstate.parse_duration(window) / archive.step
+        assert rows <= ffda_netstate.TREND_MAX_ROWS
+
+
+def test_trend_query():
+    history = ffda_netstate.TimeSeries(ffda_netstate.HISTORY_TIERS)
+    now = 1000 * 86400
+    # two days of samples every 15 minutes, with nodes rising by one
+    for i in range(192):
+        history.add(now - 2 * 86400 + i * 900, (i, 2, 10))
+    nodes, gateways, clients = history.query(3600, now)
+    assert nodes == (188, 191, 189.5)
+    assert gateways == (2, 2, 2) and clients == (10, 10, 10)
+    nodes, _, _ = history.query(ffda_netstate.parse_duration('1y'), now)
+    assert nodes == (0, 191, 95.5)
+    assert history.query(3600, now + 86400) is None
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# coding=utf8
+"""
+Measure matching nicks and hosts against block lists.
+
+    python contrib/blocklist_bench.py [--masks 1000] [--lookups 2000]
+
+Half of the masks are plain nicks and half are patterns. Each kind of
+lookup is timed with the compiled Willie.Blocklist and with the loop over
+the masks that was used before.
+"""
+from __future__ import print_function, division
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from willie.bot import Willie  # noqa: E402
+from willie.tools import Identifier  # noqa: E402
+
+
+def blocked_by_loop(masks, nick):
+    for mask in masks:
+        mask = mask.strip()
+        if not mask:
+            continue
+        if re.match(mask + '$', nick, re.IGNORECASE) or Identifier(mask) == nick:
+            return True
+    return False
+
+
+def timed(func, values, lookups):
+    start = time.time()
+    for i in range(lookups):
+        func(values[i % len(values)])
+    return (time.time() - start) / lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--masks', default=1000, type=int)
+    parser.add_argument('--lookups', default=2000, type=int)
+    args = parser.parse_args()
+
+    half = args.masks // 2
+    masks = (['spammer%d' % i for i in range(half)] +
+             [r'flood%d\w*' % i for i in range(args.masks - half)])
+    start = time.time()
+    blocklist = Willie.Blocklist(masks, Identifier._lower)
+    build = time.time() - start
+
+    lookups = {
+        'exact': [Identifier('Spammer%d' % i) for i in range(half)],
+        'pattern': [Identifier('flood%dbot' % i) for i in range(args.masks - half)],
+        'miss': [Identifier('alice%d' % i) for i in range(100)],
+    }
+    print('%d masks, compiled in %.1f ms' % (args.masks, build * 1e3))
+    print('%8s %12s %12s' % ('lookup', 'compiled', 'loop'))
+    for name in ('exact', 'pattern', 'miss'):
+        values = lookups[name]
+        compiled = timed(blocklist.match, values, args.lookups)
+        loop = timed(lambda nick: blocked_by_loop(masks, nick), values,
+                     max(args.lookups // 20, 1))
+        print('%8s %10.1fus %10.1fus' % (name, compiled * 1e6, loop * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding=utf8
+"""
+Measure how many lines per second Willie.dispatch handles.
+
+    python contrib/dispatch_bench.py [--commands 50,200,1000] [--lines 20000]
+
+Binds the given number of no-op commands plus a few catch-all rules and
+dispatches a mix of chat lines and command lines, once with the command
+index and once with every regexp tried in turn, as without it. Then it
+adds catch-all rules for the events the core tasks subscribe to and
+reports, per event, the lines per second and the regexps tried per line
+out of all bound ones. Last, it dispatches chat lines to a growing number
+of distinct catch-all rules with a list of admin hostmasks configured.
+"""
+from __future__ import print_function, division
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import willie.bot  # noqa: E402
+from willie.config import Config  # noqa: E402
+from willie.tools import Identifier  # noqa: E402
+from willie.trigger import PreTrigger  # noqa: E402
+
+
+class Scheduler(object):
+    def clear_jobs(self):
+        pass
+
+    def add_job(self, job):
+        pass
+
+
+# Events of the catch-all rules in coretasks and the bundled modules.
+EVENTS = ['JOIN', 'PART', 'QUIT', 'NICK', 'MODE', 'KICK', 'INVITE', 'CAP',
+          'AUTHENTICATE', '001', '251', '353', '477', '903']
+
+# A line of each kind, as received from the server.
+EVENT_LINES = {
+    'PRIVMSG': ':Foo!foo@example.com PRIVMSG #channel :just talking',
+    'JOIN': ':Foo!foo@example.com JOIN #channel',
+    'PART': ':Foo!foo@example.com PART #channel :bye',
+    'QUIT': ':Foo!foo@example.com QUIT :Quit: bye',
+    'MODE': ':ChanServ!cs@services. MODE #channel +o Foo',
+    '353': ':irc.example.com 353 Willie = #channel :Willie @Foo +Bar',
+    '372': ':irc.example.com 372 Willie :- message of the day',
+    'PING': 'PING :irc.example.com',
+}
+
+
+def make_callable(name, commands=None, rule=None, event=None):
+    def func(bot, trigger):
+        pass
+    func.__name__ = str(name)
+    func.thread = False
+    if commands:
+        func.commands = commands
+    if rule:
+        func.rule = [rule]
+    if event:
+        func.event = event
+    return func
+
+
+def make_bot(count, rules=5, events=(), admins=0, distinct=False):
+    config = Config('', load=False)
+    config.parser.set('core', 'prefix', r'\.')
+    config.parser.set('core', 'owner', 'Owner')
+    config.parser.set('core', 'admins', ','.join('admin%d@*.example.net' % i
+                                                 for i in range(admins)))
+    bot = willie.bot.Willie.__new__(willie.bot.Willie)
+    bot.config = config
+    bot.nick = Identifier('Willie')
+    bot.doc = {}
+    bot.times = {}
+    bot._blocklists = {}
+    bot.scheduler = Scheduler()
+    bot.callables = set(make_callable('command%d' % i, ['command%d' % i])
+                        for i in range(count))
+    # Distinct rules match separately, as rules of different modules do.
+    bot.callables.update(make_callable('rule%d' % i, rule='.*(?#%d)' % i if distinct else '.*')
+                         for i in range(rules))
+    # Each in its own module, as they would be, with a distinct regexp.
+    bot.callables.update(make_callable('on_%s' % event, rule='(.*)', event=[event])
+                         for event in events)
+    bot.callables.update(make_callable('on_%s_args' % event, rule='(.*?)', event=[event])
+                         for event in events)
+    bot.bind_commands()
+    return bot
+
+
+def make_lines(count, commands, seed=5):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        if i % 4 == 0:
+            text = '.command%d some arguments' % rng.randrange(commands)
+        elif i % 4 == 1:
+            text = '.unknown%d' % i
+        else:
+            text = 'just talking about line %d' % i
+        pretrigger = PreTrigger(Identifier('Willie'),
+                                ':Foo!foo@example.com PRIVMSG #channel :' + text)
+        lines.append(pretrigger)
+    return lines
+
+
+def run(bot, lines):
+    start = time.time()
+    for pretrigger in lines:
+        bot.dispatch(pretrigger)
+    return len(lines) / (time.time() - start)
+
+
+def tried(bot, text, event):
+    """The regexps dispatch tries for a line."""
+    word = bot._command_word.match(text) if bot._command_word else None
+    count = 0
+    for priority in ('high', 'medium', 'low'):
+        count += len(bot._rules.get(event, {}).get(priority, ()))
+        if word:
+            index = bot._command_index.get(event, {}).get(priority, {})
+            count += len(index.get(word.group(1).lower(), ()))
+    return count
+
+
+def bench_events(count, lines):
+    bot = make_bot(count, events=EVENTS)
+    bound = len(set(regexp for priority in bot.commands.values() for regexp in priority))
+    print('%8s %14s %8s' % ('event', 'lines', 'regexps'))
+    for event in sorted(EVENT_LINES):
+        pretrigger = PreTrigger(Identifier('Willie'), EVENT_LINES[event])
+        rate = run(bot, [pretrigger] * lines)
+        print('%8s %10.0f l/s %4d/%d' % (event, rate, tried(bot, pretrigger.args[-1], event),
+                                         bound))
+
+
+def bench_rules(lines, admins=20):
+    print('%8s %14s' % ('rules', 'lines'))
+    pretrigger = PreTrigger(Identifier('Willie'), EVENT_LINES['PRIVMSG'])
+    for rules in (1, 10, 50):
+        bot = make_bot(0, rules, admins=admins, distinct=True)
+        print('%8d %10.0f l/s' % (rules, run(bot, [pretrigger] * lines)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--commands', default='50,200,1000',
+                        type=lambda v: [int(s) for s in v.split(',')])
+    parser.add_argument('--lines', default=20000, type=int)
+    args = parser.parse_args()
+
+    print('%8s %14s %14s' % ('commands', 'indexed', 'scan'))
+    for count in args.commands:
+        lines = make_lines(args.lines, count)
+        indexed = run(make_bot(count), lines)
+        # Bind without the index: no command counts as a plain word.
+        plain = willie.bot.COMMAND_WORD
+        willie.bot.COMMAND_WORD = re.compile(r'(?!)')
+        try:
+            scan = run(make_bot(count), lines)
+        finally:
+            willie.bot.COMMAND_WORD = plain
+        print('%8d %10.0f l/s %10.0f l/s' % (count, indexed, scan))
+    print()
+    bench_events(max(args.commands), args.lines)
+    print()
+    bench_rules(args.lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+# coding=utf8
+"""Tests for binding and dispatching callables"""
+from __future__ import unicode_literals
+
+import re
+import threading
+import time
+
+import pytest
+
+from willie.bot import Willie
+from willie import module
+from willie.config import Config
+from willie.tools import Identifier, get_command_word_regexp
+from willie.trigger import PreTrigger
+
+
+class MockScheduler(object):
+    def clear_jobs(self):
+        pass
+
+    def add_job(self, job):
+        pass
+
+
+def make_bot(callables, prefix=r'\.'):
+    config = Config('', load=False)
+    config.parser.set('core', 'prefix', prefix)
+    config.parser.set('core', 'owner', 'Owner')
+    config.parser.set('core', 'admins', '')
+    bot = Willie.__new__(Willie)
+    bot.config = config
+    bot.nick = Identifier('Willie')
+    bot.doc = {}
+    bot.times = {}
+    bot._blocklists = {}
+    bot.scheduler = MockScheduler()
+    bot.callables = set(callables)
+    bot.shutdown_methods = set()
+    bot.bind_commands()
+    return bot
+
+
+def privmsg(bot, text):
+    line = ':Foo!foo@example.com PRIVMSG #channel :' + text
+    bot.dispatch(PreTrigger(bot.nick, line))
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def callables(calls):
+    @module.commands('hello', 'hi')
+    @module.thread(False)
+    def hello(bot, trigger):
+        calls.append(('hello', trigger.group(1), trigger.group(2)))
+
+    @module.commands('kick')
+    @module.thread(False)
+    def kick(bot, trigger):
+        calls.append(('kick', trigger.group(1)))
+
+    @module.commands('hel+o')
+    @module.thread(False)
+    def hello_regexp(bot, trigger):
+        calls.append(('hello_regexp', trigger.group(1)))
+
+    @module.rule('.*')
+    @module.thread(False)
+    def everything(bot, trigger):
+        calls.append(('everything',))
+
+    @module.commands('early')
+    @module.priority('high')
+    @module.thread(False)
+    def early(bot, trigger):
+        calls.append(('early',))
+
+    @module.rule('.*')
+    @module.priority('low')
+    @module.thread(False)
+    def late(bot, trigger):
+        calls.append(('late',))
+
+    return [hello, kick, hello_regexp, everything, early, late]
+
+
+def test_command_index(callables):
+    bot = make_bot(callables)
+    assert sorted(bot._command_index['PRIVMSG']['medium']) == ['hello', 'hi', 'kick']
+    assert sorted(bot._command_index['PRIVMSG']['high']) == ['early']
+    # the regexp command and the rules are still tried on every line
+    assert len(bot._rules['PRIVMSG']['medium']) == 2
+    assert len(bot._bound['PRIVMSG']['medium']) == 5
+
+
+def test_dispatch_command(callables, calls):
+    bot = make_bot(callables)
+    privmsg(bot, '.HELLO world')
+    assert ('hello', 'HELLO', 'world') in calls
+    assert ('hello_regexp', 'HELLO') in calls
+    assert calls[-1] == ('late',)
+
+
+def test_dispatch_order(callables, calls):
+    bot = make_bot(callables)
+    privmsg(bot, '.early')
+    assert calls == [('early',), ('everything',), ('late',)]
+
+    # within a priority, regexps are tried in the order they were bound
+    del calls[:]
+    privmsg(bot, '.hello')
+    expected = [funcs[0].__name__ for _, regexp, funcs in bot._bound['PRIVMSG']['medium']
+                if regexp.match('.hello')]
+    assert [call[0] for call in calls] == expected + ['late']
+
+
+def test_privileges_not_checked(callables, calls):
+    bot = make_bot(callables)
+    line = ':Foo!foo@example.com PRIVMSG #channel :hello'
+    pretrigger = PreTrigger(bot.nick, line)
+    bot.dispatch(pretrigger)
+    assert calls == [('everything',), ('late',)]
+    # nothing read admin or owner, and no block list is set
+    assert pretrigger.privileges is None
+
+
+def test_dispatch_partial_word(callables, calls):
+    bot = make_bot(callables)
+    privmsg(bot, '.hellothere')
+    privmsg(bot, 'hello')
+    assert calls == [('everything',), ('late',)] * 2
+
+
+def test_dispatch_non_ascii_word(callables, calls):
+    bot = make_bot(callables)
+    # words that are not ASCII are matched against every regexp, so they
+    # trigger a command wherever case-insensitive matching says they do
+    text = '.\u212aick'
+    regexp = bot._command_index['PRIVMSG']['medium']['kick'][0][1]
+    privmsg(bot, text)
+    assert (('kick', text[1:]) in calls) == bool(regexp.match(text))
+
+
+def test_variable_width_prefix(callables, calls):
+    bot = make_bot(callables, prefix=r'(?:\.|Willie: )')
+    assert bot._command_word is None
+    assert not bot._command_index['PRIVMSG']['medium']
+    privmsg(bot, 'Willie: hi there')
+    assert ('hello', 'hi', 'there') in calls
+
+
+@pytest.mark.parametrize('prefix, line', [
+    (r'\.', '.Hello there'), ('!', '!Hello there'), (r'[.!]', '!Hello there'),
+    (r'[]!]', ']Hello there'), ('.', '+Hello there'), ('Willie: ', 'Willie: Hello there'),
+    (r'(?:\.|Willie: )', None), (r'\.+', None), (r'\.?', None), (r'\b\.', None),
+    (r'\.{1,2}', None), ('a|b', None),
+])
+def test_command_word_prefix(prefix, line):
+    regexp = get_command_word_regexp(prefix)
+    if line is None:
+        # the prefix may match a varying number of characters
+        assert regexp is None
+    else:
+        assert regexp.match(line).group(1) == 'Hello'
+
+
+def join(bot, nick='Foo'):
+    line = ':%s!foo@example.com JOIN #channel' % nick
+    bot.dispatch(PreTrigger(bot.nick, line))
+
+
+def test_event_tables(callables, calls):
+    @module.rule('.*')
+    @module.event('JOIN')
+    @module.thread(False)
+    def joined(bot, trigger):
+        calls.append(('joined', trigger.event))
+
+    @module.rule('.*')
+    @module.event('JOIN', 'PRIVMSG')
+    @module.thread(False)
+    def both(bot, trigger):
+        calls.append(('both', trigger.event))
+
+    bot = make_bot(callables + [joined, both])
+    assert sorted(bot._bound) == ['JOIN', 'PRIVMSG']
+    # the JOIN table has only the catch-all regexp, shared with PRIVMSG
+    assert [len(bot._bound['JOIN'][p]) for p in ('high', 'medium', 'low')] == [0, 1, 0]
+    assert bot._bound['JOIN']['medium'][0] in bot._bound['PRIVMSG']['medium']
+
+    join(bot)
+    assert sorted(calls) == [('both', 'JOIN'), ('joined', 'JOIN')]
+
+    del calls[:]
+    privmsg(bot, 'hello')
+    assert sorted(calls) == [('both', 'PRIVMSG'), ('everything',), ('late',)]
+
+    del calls[:]
+    bot.dispatch(PreTrigger(bot.nick, 'PING :server'))
+    assert calls == []
+
+    bot.unregister({'joined': joined})
+    join(bot)
+    assert calls == [('both', 'JOIN')]
+
+
+def pool_callable(name, module_name='test', priority='medium'):
+    def func(bot, trigger):
+        pass
+    func.__name__ = str(name)
+    func.__module__ = module_name
+    func.priority = priority
+    return func
+
+
+def busy_pool(workers=1, **kwargs):
+    """A pool with one worker busy until the returned event is set."""
+    pool = Willie.WorkerPool(None, workers, **kwargs)
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def hold():
+        started.release()
+        release.wait(5)
+    pool.submit(pool_callable('hold', 'hold'), hold)
+    assert started.acquire(timeout=5)
+    return pool, release
+
+
+def wait_for(pool, completed):
+    deadline = time.time() + 5
+    while pool.stats()['completed'] < completed and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.stats()['completed'] == completed
+
+
+def test_worker_pool_priorities():
+    pool, release = busy_pool()
+    done = []
+    for name, priority in (('low', 'low'), ('medium', 'medium'), ('high', 'high')):
+        pool.submit(pool_callable(name, priority=priority), done.append, name)
+    assert pool.stats()['depth'] == {'high': 1, 'medium': 1, 'low': 1}
+    release.set()
+    wait_for(pool, 4)
+    assert done == ['high', 'medium', 'low']
+    assert pool.stats()['depth'] == {'high': 0, 'medium': 0, 'low': 0}
+    assert pool.wait_max > 0
+
+
+def test_worker_pool_module_limit():
+    pool, release = busy_pool(workers=2, limits={'hold': 1})
+    # a second call of the held module has to wait for the first, while
+    # calls of other modules run on the idle worker
+    done = []
+    pool.submit(pool_callable('hold', 'hold'), done.append, 'hold')
+    pool.submit(pool_callable('other', 'other'), done.append, 'other')
+    wait_for(pool, 1)
+    assert done == ['other']
+    assert pool.stats()['running'] == 1
+    assert pool.stats()['depth']['medium'] == 1
+    release.set()
+    wait_for(pool, 3)
+    assert done == ['other', 'hold']
+
+
+def test_worker_pool_drop():
+    pool, release = busy_pool(backlog=2)
+    done = []
+    func = pool_callable('call')
+    assert pool.submit(func, done.append, 1)
+    assert pool.submit(func, done.append, 2)
+    assert not pool.submit(func, done.append, 3)
+    assert pool.dropped == 1
+    release.set()
+    wait_for(pool, 3)
+    assert done == [1, 2]
+
+
+def test_worker_pool_block():
+    pool, release = busy_pool(backlog=1, overflow='block')
+    done = []
+    func = pool_callable('call')
+    pool.submit(func, done.append, 1)
+    submitter = threading.Thread(target=pool.submit, args=(func, done.append, 2))
+    submitter.start()
+    submitter.join(0.1)
+    assert submitter.is_alive()
+    release.set()
+    submitter.join(5)
+    wait_for(pool, 3)
+    assert done == [1, 2] and pool.dropped == 0
+
+
+def test_worker_pool_needs_a_worker():
+    with pytest.raises(ValueError):
+        Willie.WorkerPool(None, 0)
+
+
+class MockTrigger(object):
+    admin = True
+
+
+def test_workers_command():
+    from willie import coretasks
+
+    class MockBot(object):
+        def reply(self, text):
+            replies.append(text)
+
+    replies = []
+    pool, release = busy_pool()
+    pool.submit(pool_callable('call', priority='low'), lambda: None)
+    bot = MockBot()
+    bot.workers = pool
+    coretasks.workers(bot, MockTrigger())
+    release.set()
+    assert replies == ['1 workers, 1 running, waiting: 0 high, 0 medium, 1 low; '
+                       '0 completed, 0 dropped, longest wait 0.0s']
+
+
+def blocked_by_loop(masks, value, nick=False):
+    """How a list of block masks matched before it was compiled."""
+    for mask in masks:
+        mask = mask.strip()
+        if not mask:
+            continue
+        if re.match(mask + '$', value, re.IGNORECASE):
+            return True
+        if (Identifier(mask) == value) if nick else (mask == value):
+            return True
+    return False
+
+
+NICK_MASKS = ['Spammer', ' bot.* ', '', 'foo[bar]', 'evil|good', '(?i)flagged', 'kick',
+              '(x)y', r'(a)\1']
+NICKS = ['spammer', 'SPAMMER', 'spammers', 'botty', 'foo{bar}', 'foob', 'evilness',
+         'xgood', 'good', 'FLAGGED', 'Kick', '\u212aick', 'alice', 'xy', 'aa', 'ax']
+
+
+@pytest.mark.parametrize('nick', NICKS)
+def test_blocklist_nicks(nick):
+    blocklist = Willie.Blocklist(NICK_MASKS, Identifier._lower)
+    nick = Identifier(nick)
+    assert blocklist.match(nick) == blocked_by_loop(NICK_MASKS, nick, nick=True)
+
+
+HOST_MASKS = [r'.*\.example\.com', 'Bad.Host', 'a+b', 'localhost']
+HOSTS = ['irc.example.com', 'example.com', 'bad.host', 'BADXHOST', 'a+b', 'aab',
+         'LOCALHOST', 'localhost.example.org']
+
+
+@pytest.mark.parametrize('host', HOSTS)
+def test_blocklist_hosts(host):
+    blocklist = Willie.Blocklist(HOST_MASKS)
+    assert blocklist.match(host) == blocked_by_loop(HOST_MASKS, host)
+
+
+def test_blocklist_compiled_once():
+    blocklist = Willie.Blocklist(['nick%d' % i for i in range(1000)] +
+                                 ['pattern%d.*' % i for i in range(1000)])
+    assert len(blocklist.words) == 1000
+    assert len(blocklist.patterns) == 1
+    assert blocklist.match('nick999') and blocklist.match('pattern999x')
+    assert not blocklist.match('nick1000')
+    # masks that can not be combined are compiled one by one
+    assert len(Willie.Blocklist(['(?i)a.*', 'b.*']).patterns) == 2
+    blocklist = Willie.Blocklist(['x.*', 'y.*', r'(a)\1', '(?P<b>b)(?P=b)'])
+    assert len(blocklist.patterns) == 3
+    assert blocklist.match('aa') and blocklist.match('BB')
+    assert not blocklist.match('ab')
+
+
+def test_blocklist_invalid_mask():
+    blocklist = Willie.Blocklist(['*.example.com', 'b.d'])
+    assert blocklist.match('*.example.com')
+    assert not blocklist.match('irc.example.com')
+    assert blocklist.match('bad')
+
+
+def test_blocklist_config(callables, calls):
+    bot = make_bot(callables)
+    assert not bot._nick_blocked(Identifier('Foo'))
+    bot.config.core.nick_blocks = ['foo']
+    blocklist = bot._blocklist('nick_blocks')
+    assert bot._nick_blocked(Identifier('Foo'))
+    assert bot._blocklist('nick_blocks') is blocklist
+
+    privmsg(bot, '.hello')
+    assert calls == []
+    bot.config.core.nick_blocks = []
+    privmsg(bot, '.hello')
+    assert ('hello', 'hello', None) in calls
@@ -2,10 +2,14 @@
 """Tests for message parsing"""
 from __future__ import unicode_literals
 
+import re
+
 import pytest
 
+from willie.config import Config
 from willie.trigger import PreTrigger, Trigger
 from willie.tools import Identifier
+import willie.trigger
 
 
 @pytest.fixture
@@ -27,4 +31,51 @@ def test_basic_pretrigger(nick):
     assert pretrigger.sender == '#octothorpe'
 
 # TODO tags, PRIVMSG to bot, intents
-# TODO Trigger tests, for what little actual logic is in there
+
+
+@pytest.fixture
+def config():
+    config = Config('', load=False)
+    config.parser.set('core', 'owner', 'Owner')
+    config.parser.set('core', 'admins', 'Admin,*@admin.example.com')
+    return config
+
+
+def make_trigger(config, nick, line=None):
+    line = line or ':%s!foo@example.com PRIVMSG #octothorpe :Hello, world' % nick
+    pretrigger = PreTrigger(Identifier('Willie'), line)
+    return Trigger(config, pretrigger, re.match('.*', pretrigger.args[-1]))
+
+
+def test_trigger_privileges(config):
+    owner = make_trigger(config, 'Owner')
+    assert owner.owner and owner.admin
+    admin = make_trigger(config, 'admin')
+    assert admin.admin and not admin.owner
+    host = make_trigger(config, 'Foo', ':Foo!foo@admin.example.com PRIVMSG #a :hi')
+    assert host.admin and not host.owner
+    user = make_trigger(config, 'Foo')
+    assert not user.admin and not user.owner
+
+
+def test_trigger_privileges_once_per_line(config):
+    pretrigger = PreTrigger(Identifier('Willie'), ':Admin!a@example.com PRIVMSG #a :hi')
+    assert pretrigger.privileges is None
+    first = Trigger(config, pretrigger, re.match('.*', 'hi'))
+    assert pretrigger.privileges is None
+    assert first.admin
+    assert pretrigger.privileges == (True, False)
+    # another match of the same line does not check the patterns again
+    config.parser.set('core', 'admins', '')
+    second = Trigger(config, pretrigger, re.match('h', 'hi'))
+    assert second.admin
+
+
+def test_hostmask_patterns_cached(config):
+    patterns = willie.trigger.get_hostmask_patterns(config)
+    assert willie.trigger.get_hostmask_patterns(config)[1] is patterns[1]
+    config.core.admins = 'Other'
+    owner, admins = willie.trigger.get_hostmask_patterns(config)
+    assert [pattern.pattern for pattern in admins] == ['Other$']
+    assert make_trigger(config, 'Other').admin
+    assert not make_trigger(config, 'Admin').admin
@@ -21,12 +21,13 @@ import sys
 import socket
 import threading
 
+from collections import defaultdict, deque
 from datetime import datetime
 from willie import tools
 import willie.irc as irc
 from willie.db import WillieDB
 from willie.tools import (stderr, PriorityQueue, Identifier, released, get_command_regexp,
-                          iteritems, itervalues)
+                          get_command_word_regexp, iteritems, itervalues)
 from willie.trigger import Trigger
 import willie.module as module
 from willie.logger import get_logger
@@ -41,6 +42,11 @@ if sys.version_info.major >= 3:
 else:
     py3 = False
 
+# Commands that are matched literally, and can be looked up by their word.
+COMMAND_WORD = re.compile(r'[A-Za-z0-9_-]+$')
+# Block masks that match just what they say, ignoring case.
+PLAIN_MASK = re.compile(r'[A-Za-z0-9_-]+$')
+
 
 class Willie(irc.Bot):
     NOLIMIT = module.NOLIMIT
@@ -97,9 +103,22 @@ class Willie(irc.Bot):
         modules. See `WillieMemory <#tools.Willie.WillieMemory>`_
         """
 
+        limits = {}
+        for limit in self.config.core.get_list('worker_limits'):
+            name, _, count = limit.partition('=')
+            limits[name.strip()] = int(count)
+        self.workers = Willie.WorkerPool(
+            self, int(self.config.core.workers or 8),
+            int(self.config.core.worker_backlog or 1000),
+            self.config.core.worker_overflow or 'drop', limits
+        )
+        """The ``WorkerPool`` which runs threaded callables."""
+
         self.scheduler = Willie.JobScheduler(self)
         self.scheduler.start()
 
+        self._blocklists = {}
+
         #Set up block lists
         #Default to empty
         if not self.config.core.nick_blocks:
@@ -193,10 +212,7 @@ class Willie(irc.Bot):
                 job = self._jobs.get()
                 with released(self._mutex):
                     if job.func.thread:
-                        t = threading.Thread(
-                            target=self._call, args=(job.func,)
-                        )
-                        t.start()
+                        self.bot.workers.submit(job.func, self._call, job.func)
                     else:
                         self._call(job.func)
                     job.next()
@@ -301,6 +317,221 @@ class Willie(irc.Bot):
             """This is an iterator. Never stops though."""
             return self
 
+    class WorkerPool(object):
+
+        """Run threaded callables on a fixed number of worker threads.
+
+        Calls wait in one queue per priority. An idle worker takes the oldest
+        call of the highest priority whose module has fewer calls running
+        than its limit in ``limits``; modules without a limit may use every
+        worker. At most ``backlog`` calls wait at a time. When the backlog is
+        full, ``submit`` drops the call if ``overflow`` is ``'drop'``, and
+        waits for room if it is ``'block'``.
+
+        ``stats`` returns the queue depths and how long calls waited, to
+        help sizing the pool. The ``.workers`` command shows them.
+
+        """
+
+        priorities = ('high', 'medium', 'low')
+
+        def __init__(self, bot, workers=8, backlog=1000, overflow='drop',
+                     limits=None):
+            if workers < 1:
+                raise ValueError('A WorkerPool needs at least one worker.')
+            self.bot = bot
+            self.workers = workers
+            self.backlog = backlog
+            self.overflow = overflow
+            self.limits = limits or {}
+            self._queues = dict((p, deque()) for p in self.priorities)
+            self._waiting = 0
+            self._running = defaultdict(int)
+            self._mutex = threading.Lock()
+            self._ready = threading.Condition(self._mutex)
+            self._room = threading.Condition(self._mutex)
+            self.submitted = 0
+            self.dropped = 0
+            self.completed = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            for i in range(workers):
+                t = threading.Thread(target=self._work,
+                                     name='WorkerPool-%d' % i)
+                t.daemon = True
+                t.start()
+
+        def submit(self, func, target, *args):
+            """Queue ``target(*args)`` for the Willie callable ``func``.
+
+            The priority and module of ``func`` decide when it runs. Returns
+            False if the call was dropped because the backlog is full.
+
+            """
+            priority = getattr(func, 'priority', 'medium')
+            if priority not in self._queues:
+                priority = 'medium'
+            with self._mutex:
+                while self._waiting >= self.backlog:
+                    if self.overflow != 'block':
+                        self.dropped += 1
+                        LOGGER.warning(
+                            "Worker backlog full, dropped a call of %s.%s",
+                            func.__module__, func.__name__
+                        )
+                        return False
+                    self._room.wait()
+                self._queues[priority].append(
+                    (time.time(), func.__module__, target, args)
+                )
+                self._waiting += 1
+                self.submitted += 1
+                self._ready.notify()
+            return True
+
+        def stats(self):
+            """Return the queue depth per priority and the call counters."""
+            with self._mutex:
+                return {
+                    'workers': self.workers,
+                    'depth': dict((p, len(q)) for p, q in iteritems(self._queues)),
+                    'running': sum(itervalues(self._running)),
+                    'submitted': self.submitted,
+                    'dropped': self.dropped,
+                    'completed': self.completed,
+                    'wait_total': self.wait_total,
+                    'wait_max': self.wait_max,
+                }
+
+        def _take(self):
+            """Remove and return the next call that may run, if any."""
+            for priority in self.priorities:
+                queue = self._queues[priority]
+                for i, call in enumerate(queue):
+                    limit = self.limits.get(call[1])
+                    if limit is None or self._running[call[1]] < limit:
+                        del queue[i]
+                        return call
+            return None
+
+        def _work(self):
+            """Run queued calls forever."""
+            while True:
+                with self._mutex:
+                    call = self._take()
+                    while call is None:
+                        self._ready.wait()
+                        call = self._take()
+                    queued, module_name, target, args = call
+                    waited = time.time() - queued
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    self._waiting -= 1
+                    self._running[module_name] += 1
+                    self._room.notify()
+                try:
+                    target(*args)
+                except Exception:
+                    self.bot.error()
+                finally:
+                    with self._mutex:
+                        self._running[module_name] -= 1
+                        self.completed += 1
+                        # A call held back by the limit of this module may
+                        # run now.
+                        self._ready.notify()
+
+    class Blocklist(object):
+
+        """Match nicks or hosts against a list of block masks.
+
+        A value is blocked if a mask, as a regular expression, matches all of
+        it ignoring case, or if it equals a mask after ``normalize``. Equal
+        values are found in a set, and so are values matching masks that are
+        plain words. The remaining masks without groups are compiled into one
+        alternation and those with groups one by one, so matching never
+        recompiles anything.
+
+        """
+
+        def __init__(self, masks, normalize=None):
+            self.normalize = normalize or (lambda value: value)
+            self.exact = set()
+            self.words = set()
+            masks = [mask.strip() for mask in masks if mask.strip()]
+            patterns = []
+            for mask in masks:
+                self.exact.add(self.normalize(mask))
+                if PLAIN_MASK.match(mask):
+                    self.words.add(mask.lower())
+                    continue
+                patterns.append(mask)
+            self.patterns = self._compile(patterns)
+            # Case-insensitive matching may equate non-ASCII characters with
+            # ASCII ones, so those values are matched against every mask.
+            self.all_patterns = self._compile(masks) if self.words else self.patterns
+
+        @staticmethod
+        def _compile(masks):
+            """Return a list of compiled patterns matching like ``masks``."""
+            valid = []
+            grouped = []
+            for mask in masks:
+                try:
+                    pattern = re.compile(mask + '$', re.IGNORECASE)
+                except re.error as e:
+                    LOGGER.warning("Ignoring invalid block mask %s: %s",
+                                   mask, e)
+                else:
+                    # Group numbers and names change in an alternation, so
+                    # backreferences would refer to another mask's groups.
+                    if pattern.groups:
+                        grouped.append(pattern)
+                    else:
+                        valid.append(mask)
+            if not valid:
+                return grouped
+            try:
+                return [re.compile('|'.join('(?:%s$)' % mask for mask in valid),
+                                   re.IGNORECASE)] + grouped
+            except (re.error, AssertionError, OverflowError):
+                # Some masks can not be combined, e.g. because of inline
+                # flags.
+                return [re.compile(mask + '$', re.IGNORECASE)
+                        for mask in valid] + grouped
+
+        def match(self, value):
+            """Return True if ``value`` is blocked."""
+            if not self.exact:
+                return False
+            if self.normalize(value) in self.exact:
+                return True
+            try:
+                value.encode('ascii')
+            except UnicodeError:
+                patterns = self.all_patterns
+            else:
+                if value.lower() in self.words:
+                    return True
+                patterns = self.patterns
+            return any(pattern.match(value) for pattern in patterns)
+
+    def _blocklist(self, name, normalize=None):
+        """Return the ``Blocklist`` of a list in the core config.
+
+        It is only built again when the list in the config changes.
+        """
+        parser = self.config.parser
+        value = (parser.get('core', name) if parser.has_option('core', name)
+                 else None)
+        cached = self._blocklists.get(name)
+        if cached is None or cached[0] != value:
+            masks = self.config.core.get_list(name)
+            cached = self._blocklists[name] = (
+                value, Willie.Blocklist(masks, normalize)
+            )
+        return cached[1]
+
     def setup(self):
         stderr("\nWelcome to Willie. Loading modules...\n\n")
         self.callables = set()
@@ -445,9 +676,20 @@ class Willie(irc.Bot):
 
     def bind_commands(self):
         self.commands = {'high': {}, 'medium': {}, 'low': {}}
+        # Each bound regexp is also kept as (order, regexp, funcs), and
+        # listed for every event one of its funcs subscribes to: under its
+        # lower-cased word in _command_index if it is a plain command, in
+        # _rules otherwise. _bound has all of them. These tables are keyed
+        # by event, then priority; the lists are sorted by bind order.
+        entries = {'high': {}, 'medium': {}, 'low': {}}
+        listed = set()
+        self._command_index = {}
+        self._rules = {}
+        self._bound = {}
+        self._command_word = get_command_word_regexp(self.config.core.prefix)
         self.scheduler.clear_jobs()
 
-        def bind(priority, regexp, func):
+        def bind(priority, regexp, func, word=None):
             # Function name is no longer used for anything, as far as I know,
             # but we're going to keep it around anyway.
             if not hasattr(func, 'name'):
@@ -491,7 +733,27 @@ class Willie(irc.Bot):
                 if doc or example:
                     for command in func.commands:
                         self.doc[command] = (doc, example)
-            self.commands[priority].setdefault(regexp, []).append(func)
+            entry = entries[priority].get(regexp)
+            if entry is None:
+                funcs = self.commands[priority][regexp] = []
+                entry = (len(entries[priority]), regexp, funcs)
+                entries[priority][regexp] = entry
+            entry[2].append(func)
+
+            for event in func.event:
+                if (event, priority, entry[0]) in listed:
+                    continue
+                listed.add((event, priority, entry[0]))
+                if event not in self._bound:
+                    self._bound[event] = {'high': [], 'medium': [], 'low': []}
+                    self._rules[event] = {'high': [], 'medium': [], 'low': []}
+                    self._command_index[event] = {'high': {}, 'medium': {}, 'low': {}}
+                self._bound[event][priority].append(entry)
+                if word is None or self._command_word is None:
+                    self._rules[event][priority].append(entry)
+                else:
+                    index = self._command_index[event][priority]
+                    index.setdefault(word.lower(), []).append(entry)
 
         for func in self.callables:
             if not hasattr(func, 'unblockable'):
@@ -563,13 +825,23 @@ class Willie(irc.Bot):
                 for command in func.commands:
                     prefix = self.config.core.prefix
                     regexp = get_command_regexp(prefix, command)
-                    bind(func.priority, regexp, func)
+                    word = command if COMMAND_WORD.match(command) else None
+                    bind(func.priority, regexp, func, word)
 
             if hasattr(func, 'interval'):
                 for interval in func.interval:
                     job = Willie.Job(interval, func)
                     self.scheduler.add_job(job)
 
+        for tables in (self._bound, self._rules):
+            for lists in itervalues(tables):
+                for listing in itervalues(lists):
+                    listing.sort()
+        for indexes in itervalues(self._command_index):
+            for index in itervalues(indexes):
+                for listing in itervalues(index):
+                    listing.sort()
+
     class WillieWrapper(object):
         def __init__(self, willie, trigger):
             # The custom __setattr__ for this class sets the attribute on the
@@ -621,10 +893,10 @@ class Willie(irc.Bot):
         if nick not in self.times:
             self.times[nick] = dict()
 
-        if not trigger.admin and \
-                not func.unblockable and \
+        if not func.unblockable and \
                 func.rate > 0 and \
-                func in self.times[nick]:
+                func in self.times[nick] and \
+                not trigger.admin:
             timediff = time.time() - self.times[nick][func]
             if timediff < func.rate:
                 self.times[nick][func] = time.time()
@@ -656,17 +928,44 @@ class Willie(irc.Bot):
         args = pretrigger.args
         event, args, text = pretrigger.event, args, args[-1]
 
-        if self.config.core.nick_blocks or self.config.core.host_blocks:
-            nick_blocked = self._nick_blocked(pretrigger.nick)
-            host_blocked = self._host_blocked(pretrigger.host)
-        else:
-            nick_blocked = host_blocked = None
+        # Only callables that subscribe to the event need to be considered.
+        bound = self._bound.get(event)
+        if bound is None:
+            return
+        rules = self._rules[event]
+        command_index = self._command_index[event]
+
+        nick_blocked = self._nick_blocked(pretrigger.nick)
+        host_blocked = self._host_blocked(pretrigger.host)
+
+        # Plain commands can only match if the line starts with their word,
+        # everything else has to be tried.
+        word = None
+        if self._command_word is not None:
+            word = self._command_word.match(text)
+            if word:
+                word = word.group(1)
+                try:
+                    word.encode('ascii')
+                except UnicodeError:
+                    # Case-insensitive matching may equate non-ASCII
+                    # characters with ASCII ones, so try all regexps.
+                    word = False
+                else:
+                    word = word.lower()
 
         list_of_blocked_functions = []
         for priority in ('high', 'medium', 'low'):
-            items = self.commands[priority].items()
+            if word is False:
+                items = bound[priority]
+            else:
+                items = rules[priority]
+                if word:
+                    commands = command_index[priority].get(word)
+                    if commands:
+                        items = sorted(items + commands)
 
-            for regexp, funcs in items:
+            for _, regexp, funcs in items:
                 match = regexp.match(text)
                 if not match:
                     continue
@@ -674,26 +973,25 @@ class Willie(irc.Bot):
                 wrapper = self.WillieWrapper(self, trigger)
 
                 for func in funcs:
-                    if (not trigger.admin and
+                    if event not in func.event:
+                        continue
+                    if ((nick_blocked or host_blocked) and
                             not func.unblockable and
-                            (nick_blocked or host_blocked)):
+                            not trigger.admin):
                         function_name = "%s.%s" % (
                             func.__module__, func.__name__
                         )
                         list_of_blocked_functions.append(function_name)
                         continue
 
-                    if event not in func.event:
-                        continue
                     if self.limit(trigger, func):
                         continue
                     if (hasattr(func, 'intents') and
                             trigger.tags.get('intent') not in func.intents):
                         continue
                     if func.thread:
-                        targs = (func, wrapper, trigger)
-                        t = threading.Thread(target=self.call, args=targs)
-                        t.start()
+                        self.workers.submit(func, self.call, func, wrapper,
+                                            trigger)
                     else:
                         self.call(func, wrapper, trigger)
 
@@ -712,26 +1010,10 @@ class Willie(irc.Bot):
             )
 
     def _host_blocked(self, host):
-        bad_masks = self.config.core.get_list('host_blocks')
-        for bad_mask in bad_masks:
-            bad_mask = bad_mask.strip()
-            if not bad_mask:
-                continue
-            if (re.match(bad_mask + '$', host, re.IGNORECASE) or
-                    bad_mask == host):
-                return True
-        return False
+        return self._blocklist('host_blocks').match(host)
 
     def _nick_blocked(self, nick):
-        bad_nicks = self.config.core.get_list('nick_blocks')
-        for bad_nick in bad_nicks:
-            bad_nick = bad_nick.strip()
-            if not bad_nick:
-                continue
-            if (re.match(bad_nick + '$', nick, re.IGNORECASE) or
-                    Identifier(bad_nick) == nick):
-                return True
-        return False
+        return self._blocklist('nick_blocks', Identifier._lower).match(nick)
 
     def _shutdown(self):
         stderr(
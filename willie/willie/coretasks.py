@@ -502,3 +502,21 @@ def blocks(bot, trigger):
             return
     else:
         bot.reply(STRINGS['huh'])
+
+
+@willie.module.commands('workers')
+@willie.module.priority('high')
+@willie.module.thread(False)
+@willie.module.unblockable
+def workers(bot, trigger):
+    """Show how busy the pool running threaded callables is."""
+    if not trigger.admin:
+        return
+    stats = bot.workers.stats()
+    bot.reply(
+        "%d workers, %d running, waiting: %s; %d completed, %d dropped, "
+        "longest wait %.1fs" % (
+            stats['workers'], stats['running'],
+            ', '.join('%d %s' % (stats['depth'][p], p)
+                      for p in bot.workers.priorities),
+            stats['completed'], stats['dropped'], stats['wait_max']))
@@ -278,6 +278,36 @@ def get_command_regexp(prefix, command):
     return re.compile(pattern, re.IGNORECASE | re.VERBOSE)
 
 
+# A prefix made of parts that each match exactly one character: literal or
+# escaped characters, class escapes, character classes and the dot.
+_FIXED_WIDTH_PREFIX = re.compile(r"""
+    (?:
+        [^\\\[\](){}|*+?^$\s\#]       # a literal character, or .
+      | \\[^A-Za-z0-9]                # an escaped character
+      | \\[dDwWsS]                    # a class escape
+      | \[\^?\]?(?:[^\]\\]|\\.)*\]    # a character class
+    )+\Z
+""", re.VERBOSE)
+
+
+def get_command_word_regexp(prefix):
+    """Return a compiled regexp that captures the command word of a line.
+
+    A regexp from ``get_command_regexp`` only matches a line if its command
+    equals the word this regexp captures as group 1, so commands can be
+    looked up by that word. If the prefix can match a varying number of
+    characters, the word is not well defined and None is returned.
+    """
+    prefix = re.sub(r"(\s)", r"\\\1", prefix)
+    if not _FIXED_WIDTH_PREFIX.match(prefix):
+        return None
+    pattern = r"(?:{prefix})".format(prefix=prefix)
+    try:
+        return re.compile(pattern + r"(\S+)", re.IGNORECASE | re.VERBOSE)
+    except re.error:
+        return None
+
+
 def deprecated(old):
     def new(*args, **kwargs):
         print('Function %s is deprecated.' % old.__name__, file=sys.stderr)
@@ -10,6 +10,32 @@ if sys.version_info.major >= 3:
     unicode = str
     basestring = str
 
+# The owner and admins values of the config the patterns below were
+# compiled from, the owner's pattern and the admins' patterns.
+_hostmask_patterns = (None, None, [])
+
+
+def get_hostmask_patterns(config):
+    """Return the compiled hostmask patterns of the owner and the admins.
+
+    The owner's pattern is None if no owner is set. The patterns are only
+    compiled again when the owner or admins in the config change.
+    """
+    global _hostmask_patterns
+    parser = config.parser
+    key = tuple(parser.get('core', name) if parser.has_option('core', name)
+                else None for name in ('owner', 'admins'))
+    patterns = _hostmask_patterns
+    if patterns[0] != key:
+        owner = config.core.owner
+        patterns = _hostmask_patterns = (
+            key,
+            willie.tools.get_hostmask_regex(owner) if owner else None,
+            [willie.tools.get_hostmask_regex(admin)
+             for admin in config.core.get_list('admins')]
+        )
+    return patterns[1], patterns[2]
+
 
 class PreTrigger(object):
     """A parsed message from the server, which has not been matched against
@@ -67,6 +93,10 @@ class PreTrigger(object):
             target = self.nick
         self.sender = target
 
+        # Whether the nick is an admin and the owner, filled in by the first
+        # Trigger that needs it.
+        self.privileges = None
+
         # Parse CTCP into a form consistent with IRCv3 intents
         if self.event == 'PRIVMSG' or self.event == 'NOTICE':
             intent_match = PreTrigger.intent_regex.match(self.args[-1])
@@ -122,10 +152,10 @@ class Trigger(unicode):
     """
     tags = property(lambda self: self._pretrigger.tags)
     """A map of the IRCv3 message tags on the message."""
-    admin = property(lambda self: self._admin)
+    admin = property(lambda self: self._privileges()[0])
     """True if the nick which triggered the command is one of the bot's admins.
     """
-    owner = property(lambda self: self._owner)
+    owner = property(lambda self: self._privileges()[1])
     """True if the nick which triggered the command is the bot's owner."""
 
     def __new__(cls, config, message, match):
@@ -133,17 +163,25 @@ class Trigger(unicode):
         self._pretrigger = message
         self._match = match
         self._is_privmsg = message.sender.is_nick()
-
-        def match_host_or_nick(pattern):
-            pattern = willie.tools.get_hostmask_regex(pattern)
-            return bool(
-                pattern.match(self.nick) or
-                pattern.match('@'.join((self.nick, self.host)))
-            )
-
-        self._admin = any(match_host_or_nick(item)
-                         for item in config.core.get_list('admins'))
-        self._owner = match_host_or_nick(config.core.owner)
-        self._admin = self.admin or self.owner
-
+        self._config = config
         return self
+
+    def _privileges(self):
+        """Return whether the nick is an admin and the owner.
+
+        This is only worked out once per line, when first asked for.
+        """
+        privileges = self._pretrigger.privileges
+        if privileges is None:
+            nick = self.nick
+            hostmask = '@'.join((nick, self.host))
+
+            def match_host_or_nick(pattern):
+                return bool(pattern.match(nick) or pattern.match(hostmask))
+
+            owner_pattern, admin_patterns = get_hostmask_patterns(self._config)
+            owner = owner_pattern is not None and match_host_or_nick(owner_pattern)
+            admin = owner or any(match_host_or_nick(pattern)
+                                 for pattern in admin_patterns)
+            privileges = self._pretrigger.privileges = (admin, owner)
+        return privileges